@@ -1,15 +1,17 @@
-import docker
 import discord
+import docker
 import asyncio
 import io
 import os
-import functools
-from typing import Optional, Union, TypedDict, cast
-from time import monotonic_ns
+import contextlib
+import sqlite3
+import tempfile
+from typing import Any, NamedTuple, Optional, Union
+from time import monotonic, monotonic_ns, time
 from os import listdir
 from os.path import isfile, join
 from discord.utils import escape_markdown
-from statistics import median, stdev
+from statistics import mean, median, stdev
 from itertools import chain
 from datetime import datetime, timezone
 from blake3 import blake3
@@ -18,84 +20,62 @@ from . import fetch
 
 from .fetch import today
 
-from .database import Database
+from .database import Counters, Database, RunStats
 
-doc = docker.from_env()
+from .async_database import AsyncDatabase
 
+from .results import InputResult, ResultError, median_abs_deviation
 
-async def build_image(msg: discord.Message, solution: bytes) -> bool:
-    print(f"Building for {msg.author.name}")
-    # status = await msg.reply("Building...", mention_author=False)
-    with open("runner/src/code.rs", "wb+") as f:
-        f.write(solution)
+from .workers import (
+    BuildFailed,
+    LocalWorker,
+    RunFailed,
+    Worker,
+    WorkerError,
+    remote_workers,
+)
 
-    loop = asyncio.get_event_loop()
+from .hardware import leaderboard_hardware
 
-    try:
-        await loop.run_in_executor(
-            None,
-            functools.partial(
-                doc.images.build, path="runner", tag=f"ferris-elf-{msg.author.id}"
-            ),
-        )
-        return True
-    except docker.errors.BuildError as err:
-        print(f"Build error: {err}")
-        e = ""
-        for chunk in err.build_log:
-            e += chunk.get("stream") or ""
-        if "Compiling[0m ferris-elf" in e:
-            e = e[e.index("Compiling[0m ferris-elf") - 18 :]
-            if len(e) < 1500:
-                await msg.reply(f"Error building benchmark: ```ansi{e}\n```")
-                return False
-        from strip_ansi import strip_ansi
-
-        e = strip_ansi(e)
-        await msg.reply(
-            f"Error building benchmark: {err}",
-            file=discord.File(io.BytesIO(e.encode("utf-8")), "build_log.txt"),
-        )
-        return False
-    # finally:
-    #    await status.delete()
+from .environment import (
+    calibration_code,
+    calibration_input,
+    calibration_interval,
+    calibration_tolerance,
+)
 
+from .users import UserNames, name_ttl
+
+from .estimates import Estimator, input_sizes
+
+# Jobs the local worker builds ahead of its benchmarks
+builder_count = int(os.getenv("FERRIS_ELF_BUILDERS", "2"))
+
+# Jobs run lowest priority first
+submission_priority = 0
+rerun_priority = 1
+
+# Seconds between database maintenance runs, which wait for a quiet period
+maintenance_interval = int(os.getenv("FERRIS_ELF_MAINTENANCE_INTERVAL", "3600"))
+
+# Seconds a worker that failed is left alone before it gets jobs again
+worker_retry = int(os.getenv("FERRIS_ELF_WORKER_RETRY", "60"))
 
-async def run_image(msg: discord.Message, input: str) -> Optional[str]:
-    print(f"Running for {msg.author.name}")
-    # input = ','.join([str(int(x)) for x in input])
-    # status = await msg.reply("Running benchmark...", mention_author=False)
-    loop = asyncio.get_event_loop()
-    try:
-        # os.environ['NVIDIA_VISIBLE_DEVICES']='all'
-        # os.environ['NVIDIA_DRIVER_CAPABILITIES']='compute,utility'
-        # out = await loop.run_in_executor(None, functools.partial(doc.containers.run, f"ferris-elf-{msg.author.id}", f"timeout 180 ./target/release/ferris-elf", environment=dict(INPUT=input), remove=True, stdout=True, mem_limit="120g", network_mode="none", runtime="nvidia"))
-        out = await loop.run_in_executor(
-            None,
-            functools.partial(
-                doc.containers.run,
-                f"ferris-elf-{msg.author.id}",
-                "timeout 180 ./profile.sh",
-                environment=dict(INPUT=input),
-                remove=True,
-                stdout=True,
-                mem_limit="120g",
-                network_mode="none",
-                cpuset_cpus="0-15",
-            ),
-        )
-        out = out.decode("utf-8")
-        print(out)
-        return str(out)
-    except docker.errors.ContainerError as err:
-        print(f"Run error: {err}")
-        await msg.reply(
-            f"Error running benchmark: {err}",
-            file=discord.File(io.BytesIO(err.stderr), "stderr.txt"),
-        )
-        return None
-    # finally:
-    #    await status.delete()
+
+async def report_build_error(msg: discord.Message, err: BuildFailed) -> None:
+    e = err.log
+    if "Compiling[0m ferris-elf" in e:
+        e = e[e.index("Compiling[0m ferris-elf") - 18 :]
+        if len(e) < 1500:
+            await msg.reply(f"Error building benchmark: ```ansi{e}\n```")
+            return
+    from strip_ansi import strip_ansi
+
+    e = strip_ansi(e)
+    await msg.reply(
+        f"Error building benchmark: {err}",
+        file=discord.File(io.BytesIO(e.encode("utf-8")), "build_log.txt"),
+    )
 
 
 def ns(v: float) -> str:
@@ -109,26 +89,44 @@ def ns(v: float) -> str:
     return f"{v:.0f}ns"
 
 
-class ResultDict(TypedDict):
-    answer: str
-    average: int
-    median: int
-    max: int
-    min: int
+def eta(seconds: float) -> str:
+    if seconds >= 60:
+        return f"{seconds / 60:.0f}m"
+    return f"{seconds:.0f}s"
+
 
+def result_counters(result: InputResult) -> Optional[Counters]:
+    if (counts := result.get("counters")) is None:
+        return None
+
+    return Counters(
+        cycles=counts["cycles"],
+        instructions=counts["instructions"],
+        cache_references=counts["cache_references"],
+        cache_misses=counts["cache_misses"],
+        branch_misses=counts["branch_misses"],
+    )
 
-class CacheGrindResult(ResultDict, total=False):
-    total_memory_accesses: int
-    total_l1_icache_misses: int
-    total_ll_icache_misses: int
-    total_l1_dcache_misses: int
-    total_ll_dcache_misses: int
 
+def formatted_counters(counted: list[Counters]) -> str:
+    """Per run averages over every input."""
+    cycles = mean(c["cycles"] for c in counted)
+    instructions = mean(c["instructions"] for c in counted)
+    references = mean(c["cache_references"] for c in counted)
+    misses = mean(c["cache_misses"] for c in counted)
+    branch_misses = mean(c["branch_misses"] for c in counted)
 
-def formatted_solutions_for(db: Database, day: int, part: int) -> str:
+    text = f"Instructions per run: **{instructions:,.0f}** ({instructions / max(cycles, 1):.2f} IPC)"
+    text += f"\nCycles: **{cycles:,.0f}**"
+    text += f"\nBranch misses: **{branch_misses:,.0f}**"
+    text += f"\nCache misses: **{misses:,.0f}** ({misses / max(references, 1) * 100:.1f}% of references)"
+    return text
+
+
+async def formatted_solutions_for(db: AsyncDatabase, day: int, part: int) -> str:
     builder = io.StringIO()
 
-    for answer, count in db.solutions_for(day, part):
+    for answer, count in await db.solutions_for(day, part):
         if answer is None or count is None:
             continue
 
@@ -142,17 +140,19 @@ def formatted_solutions_for(db: Database, day: int, part: int) -> str:
 
 async def benchmark(
     msg: discord.Message,
-    db: Database,
+    db: AsyncDatabase,
+    worker: Worker,
     code: bytes,
+    code_hash: str,
+    tag: str,
     day: int,
     part: int,
     rerun: bool,
     approve: bool = False,
+    job_id: Optional[int] = None,
+    parallel: bool = False,
+    profile: bool = False,
 ) -> None:
-    build = await build_image(msg, code)
-    if not build:
-        return
-
     day_path = fetch.get_day_input_dir(fetch.year, day)
     try:
         onlyfiles = fetch.get_input_filenames(fetch.year, day)
@@ -163,12 +163,13 @@ async def benchmark(
         return
 
     verified = False
-    results = []
-    previous_best = db.get_best(day, part, msg.author.id)
-    size = 0
-    for i, file in enumerate(onlyfiles):
-        verify = db.get_answer(file, day, part)
+    results: list[InputResult] = []
+    previous_best = await db.get_best(
+        day, part, msg.author.id, worker.hardware, parallel
+    )
 
+    answers = await db.get_answers(onlyfiles, day, part)
+    for file, verify in answers.items():
         if verify is not None:
             print("Verify", verify, "file", file)
             if approve:
@@ -176,64 +177,42 @@ async def benchmark(
                 await msg.reply("Can't approve already verified run")
                 return
 
-        with open(join(day_path, file), "r") as f:
-            input = f.read()
-        size = max(len(input), size)
+    sizes = [os.path.getsize(join(day_path, file)) for file in onlyfiles]
+    size = max(sizes)
+
+    print(f"Running for {msg.author.name} on {worker.name}")
+    start = monotonic()
+    try:
+        outputs, environment = await worker.run(
+            tag, [join(day_path, file) for file in onlyfiles], parallel, profile
+        )
+    except RunFailed as err:
+        await msg.reply(
+            f"Error running benchmark: {err}",
+            file=discord.File(io.BytesIO(err.stderr), "stderr.txt"),
+        )
+        return
+    except ResultError as err:
+        print(f"Result error: {err}")
+        await msg.reply(f"Error reading benchmark results: {err}")
+        return
+    run_time = monotonic() - start
+
+    issues = list(environment.issues)
+    if worker.drift is not None:
+        issues.append(f"calibration is off by {worker.drift * 100:+.1f}%")
+    noise = "; ".join(issues) or None
+
+    for i, file in enumerate(onlyfiles):
+        verify = answers[file]
 
         # status = await msg.reply(f"Benchmarking input {i+1}", mention_author=False)
-        out = await run_image(msg, input)
-        if not out:
+        result = outputs.get(str(i))
+        if result is None:
+            await msg.reply(f"Error: Benchmark produced no result for input {i + 1}")
             return
         # await status.delete()
 
-        result = cast(CacheGrindResult, {})
-        for line in out.splitlines():
-            if line.startswith("FERRIS_ELF_ANSWER "):
-                result["answer"] = str(line[18:]).strip()
-            if line.startswith("FERRIS_ELF_MEDIAN "):
-                result["median"] = int(line[18:])
-            if line.startswith("FERRIS_ELF_AVERAGE "):
-                result["average"] = int(line[19:])
-            if line.startswith("FERRIS_ELF_MAX "):
-                result["max"] = int(line[15:])
-            if line.startswith("FERRIS_ELF_MIN "):
-                result["min"] = int(line[15:])
-            # Total Memory Accesses...4,790,804,439
-            # FERRIS_ELF_MIN A
-            #
-            # Total L1 I-Cache Misses...13,367 (0%)
-            # Total LL I-Cache Misses...64 (0%)
-            # Total L1 D-Cache Misses...19,345,778 (0%)
-            # Total LL D-Cache Misses...555 (0%)
-            #
-            #  Ir  I1mr ILmr  Dr  D1mr DLmr  Dw  D1mw DLmw
-            # 0.96 1.00 0.83 0.94 0.99 0.00 0.79 0.11 0.01 ???:ferris_elf
-            # -----------------------------------------------------------------------
-            # 0.02 0.00 0.11 0.06 0.01 1.00 0.10 0.44 0.52 memcpy.S:__GI_memcpy
-            # -----------------------------------------------------------------------
-            # 0.02 0.00 0.06 0.00 0.00 0.00 0.12 0.45 0.47 memset.S:__GI_memset
-            # -----------------------------------------------------------------------
-            if "Total Memory Accesses" in line:
-                result["total_memory_accesses"] = int(
-                    line[33:].replace(",", "").split()[0]
-                )
-            if "Total L1 I-Cache Misses" in line:
-                result["total_l1_icache_misses"] = int(
-                    line[35:].replace(",", "").split()[0]
-                )
-            if "Total LL I-Cache Misses" in line:
-                result["total_ll_icache_misses"] = int(
-                    line[35:].replace(",", "").split()[0]
-                )
-            if "Total L1 D-Cache Misses" in line:
-                result["total_l1_dcache_misses"] = int(
-                    line[35:].replace(",", "").split()[0]
-                )
-            if "Total LL D-Cache Misses" in line:
-                result["total_ll_dcache_misses"] = int(
-                    line[35:].replace(",", "").split()[0]
-                )
-
         if verify:
             if not result["answer"] == verify:
                 await msg.reply(
@@ -244,46 +223,89 @@ async def benchmark(
         else:
             print("Cannot verify run", result["answer"])
 
-        if approve:
-            print("Approving for d {day}")
-            cur = db._get_cur()
-            cur.execute(
-                "INSERT INTO solutions VALUES (?, ?, ?, ?, ?)",
-                (file, day, part, result["answer"], result["answer"]),
-            )
-
         results.append(result)
 
     now = int(datetime.now(timezone.utc).timestamp())
-    code_hash = blake3(code).hexdigest()
-    for result in results:
-        if rerun:
-            db.update_runs(day, part, result["median"], result["answer"], code_hash)
-        else:
-            db.insert_run(
-                msg.author.id,
-                code,
-                day,
-                part,
-                result["median"],
-                result["answer"],
-                now,
-                code_hash,
-            )
+    stats = [
+        RunStats(
+            ci_low=result["ci_low"],
+            ci_high=result["ci_high"],
+            p5=result["p5"],
+            p50=result["median"],
+            p95=result["p95"],
+            mad=median_abs_deviation(result),
+            samples=result["samples"],
+        )
+        for result in results
+    ]
+
+    def store(db: Database) -> None:
+        for file, result, result_stats in zip(onlyfiles, results, stats):
+            if approve:
+                print(f"Approving for d {day}")
+                db.insert_solution(file, day, part, result["answer"])
+
+            if rerun:
+                db.update_runs(
+                    day,
+                    part,
+                    result["median"],
+                    result["answer"],
+                    code_hash,
+                    worker.hardware,
+                    parallel,
+                    result_stats,
+                    environment.fingerprint,
+                    noise,
+                )
+            else:
+                db.insert_run(
+                    msg.author.id,
+                    code,
+                    day,
+                    part,
+                    result["median"],
+                    result["answer"],
+                    now,
+                    code_hash,
+                    worker.hardware,
+                    parallel,
+                    result_stats,
+                    result_counters(result),
+                    environment.fingerprint,
+                    noise,
+                )
+
+    start = monotonic()
+    await db.write(store, (day, part))
+    store_time = monotonic() - start
+    print("Inserted results into DB")
+
+    if job_id is not None:
+        # the container runs every input, split its time by how long each
+        # input was sampled for
+        elapsed = [max(r["elapsed"], 1) for r in results]
+        await db.record_stages(
+            job_id,
+            [
+                ("input", input_size, run_time * e / sum(elapsed))
+                for input_size, e in zip(sizes, elapsed)
+            ]
+            + [("store", len(results), store_time)],
+        )
 
     best = min([int(r["median"]) for r in results])
     med = median([int(r["median"]) for r in results])
     dev = stdev(
         chain([int(r["min"]) for r in results], [int(r["max"]) for r in results])
     )
-    # total_memory_accesses = mean([int(r["total_memory_accesses"]) for r in results])
-    # total_l1_icache_misses = mean([int(r["total_l1_icache_misses"]) for r in results])
-    # total_ll_icache_misses = mean([int(r["total_ll_icache_misses"]) for r in results])
-    # total_l1_dcache_misses = mean([int(r["total_l1_dcache_misses"]) for r in results])
-    # total_ll_dcache_misses = mean([int(r["total_ll_dcache_misses"]) for r in results])
+    # widest confidence interval of any input, relative to its median
+    ci = max((r["ci_high"] - r["ci_low"]) / 2 / (r["median"] + 1) for r in results)
+    samples = sum(len(r["samples"]) for r in results)
 
     title = "Benchmark complete" if verified else "Benchmark complete (Unverified)"
     text = f"Median: **{ns(med)} ±{ns(dev)}**\nThroughput: **{size * 1000 / (med + 1):.2f}MB/s**"
+    text += f"\nConfidence: **±{ci * 100:.2f}%** ({samples} samples)"
     if previous_best is not None:
         if (
             not (abs(previous_best - best) < 100)
@@ -292,25 +314,84 @@ async def benchmark(
         ):
             direction = "+" if previous_best < best else "-"
             text += f"\nChange: **{direction}{ns(abs(previous_best - best))} {abs(((previous_best - best) / (previous_best + 1)) * 100):.2f}%**"
-    # await msg.reply(embed=discord.Embed(title="Benchmark complete", description=f"Median: **{ns(median)}**\nAverage: **{ns(average)}**\nTotal Memory Accesses: **{total_memory_accesses:,.2f}**\nTotal L1 I-Cache Misses: **{total_l1_icache_misses:,.2f}**\nTotal LL I-Cache Misses: **{total_ll_icache_misses:,.2f}**\nTotal L1 D-Cache Misses: **{total_l1_dcache_misses:,.2f}**\nTotal LL D-Cache Misses: **{total_ll_dcache_misses:,.2f}**"))
-    await msg.reply(
-        embed=discord.Embed(
-            title=title,
-            description=text,
-            color=0xE43A25
-            if previous_best is not None and previous_best < best
-            else 0x41E425,
+    if profile:
+        counted = [c for r in results if (c := result_counters(r)) is not None]
+        if counted:
+            text += "\n" + formatted_counters(counted)
+        else:
+            text += "\nHardware counters are unavailable on this machine"
+    if noise is not None:
+        text += f"\n⚠️ Noisy environment, times may be off and aren't ranked: {noise}"
+    embed = discord.Embed(
+        title=title,
+        description=text,
+        color=0xE43A25
+        if previous_best is not None and previous_best < best
+        else 0x41E425,
+    )
+    # times are only comparable on the same hardware
+    embed.set_footer(
+        text=f"Benchmarked on {worker.hardware}"
+        + (", every core" if parallel else ", one core")
+    )
+    await msg.reply(embed=embed)
+
+
+def write_file(path: str, data: bytes) -> None:
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+async def calibrate(db: AsyncDatabase, worker: Worker) -> None:
+    """
+    Runs the calibration benchmark on `worker` and sets its drift from the
+    previous calibrations in the same environment.
+    """
+    code_hash = blake3(calibration_code).hexdigest()
+    with tempfile.TemporaryDirectory(prefix="ferris-elf-calibration-") as input_dir:
+        path = join(input_dir, "calibration")
+        await asyncio.get_running_loop().run_in_executor(
+            None, write_file, path, calibration_input()
         )
+        tag = await worker.build(calibration_code, code_hash)
+        try:
+            outputs, environment = await worker.run(tag, [path])
+        finally:
+            await worker.release(tag)
+
+    if environment.issues:
+        print(f"Skipping calibration of {worker.name}: {'; '.join(environment.issues)}")
+        return
+
+    calibration_time = outputs["0"]["median"]
+    baseline = await db.record_calibration(
+        worker.name,
+        worker.hardware,
+        environment.fingerprint,
+        calibration_time,
+        calibration_tolerance(),
     )
+    if baseline is None:
+        print(f"Calibrated {worker.name}: {ns(calibration_time)}, no baseline yet")
+        worker.drift = None
+        return
 
-    db.commit()
-    print("Inserted results into DB")
+    drift = calibration_time / baseline - 1
+    print(f"Calibrated {worker.name}: {ns(calibration_time)}, {drift * 100:+.1f}%")
+    if abs(drift) > calibration_tolerance():
+        print(f"Warning: {worker.name} drifted from its calibration baseline")
+        worker.drift = drift
+    else:
+        worker.drift = None
 
 
 async def formatted_scores_for(
     author: Union[discord.User, discord.Member],
     bot: discord.Client,
-    db: Database,
+    db: AsyncDatabase,
+    user_names: UserNames,
+    hardware: str,
+    parallel: bool,
     day: int,
     part: int,
 ) -> str:
@@ -323,25 +404,37 @@ async def formatted_scores_for(
     else:
         guild = None
 
-    for opt_user, bench_time in db.get_scores_lb(day, part):
-        if opt_user is None or bench_time is None:
-            continue
+    rows = [
+        (int(opt_user), bench_time)
+        for opt_user, bench_time in await db.get_scores_lb(
+            day, part, hardware, parallel
+        )
+        if opt_user is not None and bench_time is not None
+    ]
 
-        user = int(opt_user)
+    # if the aoc command was sent in a guild that isnt the guild of the user we have here, then using <@id>
+    # will render as <@id>, instead of as @person, so we have to fallback to using the name directly
+    def mentionable(user: int) -> bool:
+        return guild is not None and guild.get_member(user) is not None
+
+    # resolve names a screenful at a time, about as many lines as fit in the
+    # 800 characters below
+    for start in range(0, len(rows), 25):
+        chunk = rows[start : start + 25]
+        names = await user_names.resolve(
+            user for user, _ in chunk if not mentionable(user)
+        )
 
-        # if the aoc command was sent in a guild that isnt the guild of the user we have here, then using <@id>
-        # will render as <@id>, instead of as @person, so we have to fallback to using the name directly
-        if guild is None or guild.get_member(user) is None:
-            userobj = bot.get_user(user) or await bot.fetch_user(user)
-            if userobj:
+        for user, bench_time in chunk:
+            if mentionable(user):
+                builder.write(f"\t<@{user}>: **{ns(bench_time)}**\n")
+            elif user in names:
                 builder.write(
-                    f"\t{escape_markdown(userobj.name)}: **{ns(bench_time)}**\n"
+                    f"\t{escape_markdown(names[user])}: **{ns(bench_time)}**\n"
                 )
-            continue
-        builder.write(f"\t<@{user}>: **{ns(bench_time)}**\n")
 
-        if len(builder.getvalue()) > 800:
-            break
+            if len(builder.getvalue()) > 800:
+                return builder.getvalue()
 
     return builder.getvalue()
 
@@ -349,7 +442,10 @@ async def formatted_scores_for(
 async def formatted_best(
     author: Union[discord.User, discord.Member],
     bot: discord.Client,
-    db: Database,
+    db: AsyncDatabase,
+    user_names: UserNames,
+    hardware: str,
+    parallel: bool,
     part: int,
 ) -> (str, float):
     builder = io.StringIO()
@@ -361,7 +457,11 @@ async def formatted_best(
     else:
         guild = None
     tot = 0
-    for opt_day, _opt_part, opt_user, opt_bench_time in db.get_best_lb(part):
+    rows = await db.get_best_lb(part, hardware, parallel)
+    names = await user_names.resolve(
+        int(opt_user) for _, _, opt_user, _ in rows if opt_user is not None
+    )
+    for opt_day, _opt_part, opt_user, opt_bench_time in rows:
         if (
             opt_day is None
             or _opt_part is None
@@ -375,21 +475,27 @@ async def formatted_best(
 
         # if the aoc command was sent in a guild that isnt the guild of the user we have here, then using <@id>
         # we have to fallback to using the name directly, due to 60 * 2 * 25 > 1024
-        userobj = bot.get_user(user) or await bot.fetch_user(user)
-        if userobj:
+        if user in names:
             builder.write(
-                f"\td{opt_day:<3} **{escape_markdown(userobj.name)}**: **{ns(opt_bench_time)}**\n"
+                f"\td{opt_day:<3} **{escape_markdown(names[user])}**: **{ns(opt_bench_time)}**\n"
             )
 
     return (builder.getvalue(), tot)
 
 
 async def leaderboard_cmd(
-    client: discord.Client, db: Database, msg: discord.Message
+    client: discord.Client,
+    db: AsyncDatabase,
+    user_names: UserNames,
+    hardware: str,
+    msg: discord.Message,
 ) -> None:
     timeit = monotonic_ns()
 
     parts = msg.content.split(" ")
+    # runs on every core are ranked apart from runs on one core
+    parallel = "parallel" in parts[1:]
+    parts = [word for word in parts if word != "parallel"]
 
     try:
         day = int(parts[1])
@@ -414,8 +520,12 @@ async def leaderboard_cmd(
 
     print(f"Best for d {day}")
 
-    part1 = await formatted_scores_for(msg.author, client, db, day, 1)
-    part2 = await formatted_scores_for(msg.author, client, db, day, 2)
+    part1 = await formatted_scores_for(
+        msg.author, client, db, user_names, hardware, parallel, day, 1
+    )
+    part2 = await formatted_scores_for(
+        msg.author, client, db, user_names, hardware, parallel, day, 2
+    )
 
     embed = discord.Embed(
         title=f"Top 10 fastest toboggans for day {day}", color=0xE84611
@@ -428,16 +538,27 @@ async def leaderboard_cmd(
 
     end = ns(monotonic_ns() - timeit)
 
-    embed.set_footer(text=f"Computed in {end}")
+    embed.set_footer(
+        text=f"Computed in {end} for {hardware}"
+        + (", every core" if parallel else ", one core")
+    )
 
     await msg.reply(embed=embed)
     return
 
 
-async def best_cmd(client: discord.Client, db: Database, msg: discord.Message) -> None:
+async def best_cmd(
+    client: discord.Client,
+    db: AsyncDatabase,
+    user_names: UserNames,
+    hardware: str,
+    msg: discord.Message,
+) -> None:
     timeit = monotonic_ns()
 
     parts = msg.content.split(" ")
+    parallel = "parallel" in parts[1:]
+    parts = [word for word in parts if word != "parallel"]
 
     if len(parts) > 2:
         # if there were more words passed just skip it
@@ -450,8 +571,12 @@ async def best_cmd(client: discord.Client, db: Database, msg: discord.Message) -
 
     print("Best overall")
 
-    best1, p1 = await formatted_best(msg.author, client, db, 1)
-    best2, p2 = await formatted_best(msg.author, client, db, 2)
+    best1, p1 = await formatted_best(
+        msg.author, client, db, user_names, hardware, parallel, 1
+    )
+    best2, p2 = await formatted_best(
+        msg.author, client, db, user_names, hardware, parallel, 2
+    )
     best1 += f"\t⎯⎯⎯\n{ns(p1 + p2)}"
 
     embed = discord.Embed(title="Top fastest toboggans for all days", color=0xE84611)
@@ -463,14 +588,17 @@ async def best_cmd(client: discord.Client, db: Database, msg: discord.Message) -
 
     end = ns(monotonic_ns() - timeit)
 
-    embed.set_footer(text=f"Computed in {end}")
+    embed.set_footer(
+        text=f"Computed in {end} for {hardware}"
+        + (", every core" if parallel else ", one core")
+    )
 
     await msg.reply(embed=embed)
     return
 
 
 async def migrate_hash_cmd(
-    client: discord.Client, db: Database, msg: discord.Message
+    client: discord.Client, db: AsyncDatabase, msg: discord.Message
 ) -> None:
     authorized = [
         117530756263182344,  # iwearapot
@@ -479,17 +607,46 @@ async def migrate_hash_cmd(
         await msg.reply("(For helptext, Direct Message me `help`)")
         return
 
-    for row_id, opt_code in db.get_runs_without_hash():
-        if opt_code is None:
-            continue
+    total = await db.read(lambda d: d.count_runs_without_hash())
+    status = await msg.reply(f"Hashing code of {total} runs")
+
+    loop = asyncio.get_running_loop()
+    after = 0
+    done = 0
+    last_report = monotonic_ns()
+    # a batch at a time, so that only one batch of code is held in memory
+    while rows := await db.get_runs_without_hash(after):
+        after = rows[-1][0]
+        hashed = await loop.run_in_executor(None, hash_runs, rows)
+        await db.update_code_hashes(hashed)
+
+        done += len(rows)
+        print(f"Hashed code of {done}/{total} runs")
+        # progress edits are rate limited, don't make one per batch
+        if monotonic_ns() - last_report > 5_000_000_000:
+            last_report = monotonic_ns()
+            await status.edit(content=f"Hashing code of {total} runs: {done} done")
+
+    await status.edit(content=f"Hashed code of {done} runs")
+
+
+def hash_runs(rows: list[tuple[int, Optional[bytes]]]) -> list[tuple[int, str, bytes]]:
+    return [
+        (row_id, blake3(code).hexdigest(), code)
+        for row_id, code in rows
+        if code is not None
+    ]
+
 
-        code_hash = blake3(opt_code).hexdigest()
-        print(f"Setting hash of row {row_id} to {code_hash}")
-        db.update_code_hash(row_id, code_hash)
-    db.commit()
+async def migrate_code_blobs(db: AsyncDatabase) -> None:
+    """Moves code stored inline in runs into code_blobs, a batch at a time."""
+    after = 0
+    while (last := await db.write(lambda d: d.migrate_code_blobs(after))) is not None:
+        after = last
+    print("Code blob migration complete")
 
 
-async def rerun_cmd(client: discord.Client, db: Database, msg: discord.Message) -> None:
+async def rerun_cmd(client: "MyBot", db: AsyncDatabase, msg: discord.Message) -> None:
     authorized = [
         117530756263182344,  # iwearapot
     ]
@@ -497,29 +654,14 @@ async def rerun_cmd(client: discord.Client, db: Database, msg: discord.Message)
         await msg.reply("(For helptext, Direct Message me `help`)")
         return
 
-    try:
-        opt_invalid_run = db.get_next_invalid_run()
-        if opt_invalid_run is None:
-            await msg.reply("No targets to re-run.")
-            return
-
-        (opt_day, opt_part, opt_answer, opt_code, opt_code_hash) = opt_invalid_run
-        if (
-            opt_day is None
-            or opt_part is None
-            or opt_answer is None
-            or opt_code is None
-            or opt_code_hash is None
-        ):
-            await msg.reply("Invalid re-run target.")
-            return
-
-        await msg.reply(
-            f"Queued rerun of d{opt_day}p{opt_part} for {opt_code_hash} for {msg.author} (Queue length) {client.queue.qsize()}"
-        )
-        client.queue.put_nowait((msg, opt_code, opt_day, opt_part, True))
-    except Exception as err:
-        print("Rerun loop exception!", err)
+    pending = await db.plan_reruns(msg.channel.id, msg.id)
+    counts = await db.rerun_counts()
+    text = f"Queued {pending} reruns ({counts.get('done', 0)} done, {counts.get('failed', 0)} failed so far)"
+    # reruns go after submissions, so this is a lower bound
+    if (each := Estimator(await db.stage_history()).benchmark_time()) is not None:
+        text += f", about {eta(pending * each / max(client.benchmarks(), 1))} to go"
+    await msg.reply(text)
+    client.reruns_planned.set()
 
 
 async def handle_dm_commands(client: "MyBot", msg: discord.Message) -> None:
@@ -531,11 +673,15 @@ async def handle_dm_commands(client: "MyBot", msg: discord.Message) -> None:
                 description="""
 **help** - Send this message
 **info** - Some useful information about benchmarking
-**aoc _[day]_** - Best times so far
-**best** - Best times for all days and parts
-**_[day]_ _[part]_ <attachment>** - Benchmark attached code
+**aoc _[day]_ _[parallel]_** - Best times so far
+**best _[parallel]_** - Best times for all days and parts
+**queue** - Queued benchmarks and how long they will take
+**_[day]_ _[part]_ _[parallel]_ _[profile]_ <attachment>** - Benchmark attached code
 
-If [_day_] and/or [_part_] is omitted, they are assumed to be today and part 1
+If [_day_] and/or [_part_] is omitted, they are assumed to be today and part 1. \
+Add `parallel` to benchmark on every core instead of one, and `profile` to \
+also count instructions, cycles, branch and cache misses. Runs on every core \
+have leaderboards of their own, add `parallel` to `aoc` and `best` to see them
 
 Message <@210141176211177474> for any questions""",
             )
@@ -609,9 +755,14 @@ If you'd like a dependency be added, please send a message to <@2101411762111774
 Benchmarks are run on dedicated hardware in my basement. The hardware \
 consists of a dedicated server with an Intel Xeon W-2145 processor with 16 threads. \
 There is 128 gigabytes of DDR4 available to your benchmark.
-You benchmark is first ran for 5 seconds to warm up the cores, and then \
-benchmarked for another 5. Please do not memoize any values in global state, a \
-call to `run` should always perform all of the work.
+Benchmarks run side by side, each on a physical core of its own. Add `parallel` \
+after the day and part to get all 16 threads, e.g. for rayon, which may take \
+longer to start as it waits for the whole machine. Such runs, and runs from \
+before benchmarks ran side by side, are ranked on leaderboards of their own.
+You benchmark is first ran for a second to warm up the cores, and then \
+benchmarked until the median is known to within 1%, for 1 to 10 seconds. \
+Please do not memoize any values in global state, a call to `run` should \
+always perform all of the work.
 
 
 Be kind and do not abuse :)""",
@@ -720,8 +871,8 @@ Be kind and do not abuse :)""",
 
         print(f"Solutions for d {day}")
 
-        part1 = formatted_solutions_for(client.db, day, 1)
-        part2 = formatted_solutions_for(client.db, day, 2)
+        part1 = await formatted_solutions_for(client.db, day, 1)
+        part2 = await formatted_solutions_for(client.db, day, 2)
 
         embed = discord.Embed(title=f"Submitted answers for day {day}", color=0xE84611)
 
@@ -794,8 +945,7 @@ Be kind and do not abuse :)""",
             return
 
         print(f"Approving for d {day}")
-        cur = client.db._get_cur()
-        cur.execute("INSERT INTO solutions VALUES (?, ?, ?, ?, ?)", (input_id, day, part, answer, answer))
+        await client.db.insert_solution(input_id, day, part, answer)
 
         # FIXME(ultrabear): part has been replaced with a quoted string because it is not init as a variable
         # this entire section of code is a deletion candidate too, assess after ruff check pass is completed
@@ -810,72 +960,411 @@ Be kind and do not abuse :)""",
 
     print("foobar")
 
-    if not client.queue.empty():
-        await msg.reply("Benchmark queued...", mention_author=False)
-    else:
+    job_id = await client.db.enqueue_job(
+        msg.author.id, msg.channel.id, msg.id, submission_priority
+    )
+    client.jobs_queued.set()
+    print("Queued for", msg.author)
+
+    queue = await estimate_queue(client.db, client.benchmarks())
+    position = next((i for i, job in enumerate(queue) if job[0] == job_id), None)
+    if position is None or queue[position][2]:
         await msg.reply("Benchmark running...", mention_author=False)
+        return
+
+    text = f"Benchmark queued, {position} ahead of you"
+    if (finish := queue[position][3]) is not None:
+        text += f", done in about {eta(finish)}"
+    await msg.reply(f"{text}...", mention_author=False)
+
+
+async def estimate_queue(
+    db: AsyncDatabase, machines: int
+) -> list[tuple[int, str, bool, Optional[float]]]:
+    """
+    Id, user, whether it is running, and estimated seconds until finished of
+    every running and then queued job, benchmarked on `machines` workers.
+    """
+    snapshot = await db.queue_snapshot()
+    estimator = Estimator(await db.stage_history())
+
+    days = {day for _, _, _, day in snapshot if day is not None}
+    sizes = await asyncio.get_running_loop().run_in_executor(
+        None, lambda: {day: input_sizes(day) for day in days}
+    )
+
+    now = time()
+
+    etas = estimator.finish_times(
+        [
+            (
+                None if started is None else now - started,
+                None if day is None else sizes[day],
+            )
+            for _, _, started, day in snapshot
+        ],
+        machines,
+    )
+    return [
+        (job_id, user, started is not None, finish)
+        for (job_id, user, started, _), finish in zip(snapshot, etas)
+    ]
+
+
+async def queue_cmd(client: "MyBot", db: AsyncDatabase, msg: discord.Message) -> None:
+    parts = msg.content.split(" ")
+
+    if len(parts) > 1:
+        # it probably wasn't for us
+        return
+
+    queue = await estimate_queue(db, client.benchmarks())
+    build, run, store = Estimator(await db.stage_history()).stages()
+    finished = await db.read(lambda d: d.jobs_finished_since(time() - 60 * 60))
+
+    running = sum(1 for _, _, started, _ in queue if started)
+    text = f"Jobs in progress: **{running}**\nQueued: **{len(queue) - running}**"
+    text += f"\nWorkers: **{len(client.workers)}**, benchmarking **{client.benchmarks()}** at a time"
+    if queue and (last := queue[-1][3]) is not None:
+        text += f"\nQueue empty in about **{eta(last)}**"
+
+    mine = [
+        (i, finish)
+        for i, (_, user, started, finish) in enumerate(queue)
+        if user == str(msg.author.id) and not started
+    ]
+    if mine:
+        position, finish = mine[0]
+        text += f"\nYour next job: **{position}** ahead of it"
+        if finish is not None:
+            text += f", done in about **{eta(finish)}**"
+
+    text += f"\n\nFinished in the last hour: **{finished}**"
+    if build is not None and run is not None:
+        text += f"\nAverage build: **{eta(build)}**, benchmark: **{eta(run)}**, store: **{store * 1000:.0f}ms**"
+
+    await msg.reply(
+        embed=discord.Embed(title="Benchmark queue", description=text, color=0xE84611)
+    )
+
+
+class Submission(NamedTuple):
+    code: bytes
+    day: int
+    part: int
+    approve: bool
+    # gets every benchmark CPU instead of a slot of its own
+    parallel: bool
+    # also counts hardware events
+    profile: bool
+
+
+async def read_submission(
+    msg: discord.Message,
+    opt_code: Optional[bytes],
+    opt_day: Optional[int],
+    opt_part: Optional[int],
+    opt_parallel: bool,
+    rerun: Optional[int],
+) -> Optional[Submission]:
+    if rerun is not None:
+        if opt_code is None or opt_day is None or opt_part is None:
+            return None
+
+        return Submission(opt_code, opt_day, opt_part, False, opt_parallel, False)
+
+    print(f"Processing request for {msg.author.name}")
+    code = await msg.attachments[0].read()
+    parts = [p for p in msg.content.split(" ") if p]
+
+    if len(parts) < 2:
+        await msg.reply(
+            "Looks like you forgot to specify `<day> <part>`. Submit again, with a message like `4 2` if your code is for day 4 part 2."
+        )
+        return None
+
+    day = int((parts[0:1] or (today(),))[0])
+    part = int((parts[1:2] or (1,))[0])
+
+    approve = "approve" in parts[2:] and msg.author.id in [
+        117530756263182344,  # iwearapot
+        696196765564534825,  # bendn
+        210141176211177474,  # noxim
+    ]
 
-    print("Queued for", msg.author, "(Queue length)", client.queue.qsize())
-    client.queue.put_nowait((msg, None, None, None, False))
+    return Submission(
+        code, day, part, approve, "parallel" in parts[2:], "profile" in parts[2:]
+    )
 
 
 # print(benchmark(1234, code))
 class MyBot(discord.Client):
-    queue = asyncio.Queue[
-        tuple[discord.Message, Optional[bytes], Optional[int], Optional[int], bool]
-    ]()
-    db: Database
+    # Set when jobs are added to the queue in the database
+    jobs_queued: asyncio.Event
+    # Jobs claimed from the queue that haven't finished yet
+    active = 0
+    db: AsyncDatabase
+    user_names: UserNames
+    # Machines jobs are dispatched to, and the one this bot runs on, if any
+    workers: list[Worker]
+    local: Optional[LocalWorker]
+    # Hardware class the leaderboards show
+    hardware: str
+
+    # One per slot of every worker
+    runners: list[asyncio.Task[None]]
+    reruns_planned: asyncio.Event
+    reruns: asyncio.Task[None]
+    migration: asyncio.Task[None]
+    maintenance: asyncio.Task[None]
+    calibration: asyncio.Task[None]
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.jobs_queued = asyncio.Event()
+        self.runners = []
+        self.reruns_planned = asyncio.Event()
+
+    def slots(self) -> int:
+        return sum(worker.slots for worker in self.workers)
+
+    def benchmarks(self) -> int:
+        return sum(worker.benchmarks for worker in self.workers)
+
+    async def runner(self, worker: Worker) -> None:
+        while True:
+            # cleared before looking, so a job queued meanwhile isn't missed
+            self.jobs_queued.clear()
+            claimed = await self.db.claim_job()
+            if claimed is None:
+                await self.jobs_queued.wait()
+                continue
+
+            job_id, channel, message, rerun = claimed
+            self.active += 1
+            status = "failed"
+            try:
+                status = await self.run_job(worker, job_id, channel, message, rerun)
+            except WorkerError as err:
+                # not the submission's fault, leave it to the other workers
+                print(f"Requeueing job {job_id}: {err}")
+                self.active -= 1
+                await self.db.requeue_job(job_id)
+                self.jobs_queued.set()
+                await asyncio.sleep(worker_retry)
+                continue
+            except Exception as err:
+                print("Job loop exception!", err)
+
+            await self.finish_job(job_id, rerun, status)
+
+    async def run_job(
+        self,
+        worker: Worker,
+        job_id: int,
+        channel: int,
+        message: int,
+        rerun: Optional[int],
+    ) -> str:
+        """Builds and benchmarks a claimed job on `worker`, returning its status."""
+        msg = await self.fetch_message(channel, message)
+        if msg is None:
+            return "failed"
+
+        opt_code = opt_day = opt_part = None
+        opt_parallel = False
+        if rerun is not None and (target := await self.db.get_rerun(rerun)):
+            opt_day, opt_part, _, opt_code, opt_parallel = target
+
+        # failing to build counts as an attempt for reruns
+        submission = await read_submission(
+            msg, opt_code, opt_day, opt_part, opt_parallel, rerun
+        )
+        if submission is None:
+            return "done"
+
+        code_hash = blake3(submission.code).hexdigest()
+
+        print(f"Building for {msg.author.name} on {worker.name}")
+        start = monotonic()
+        try:
+            tag = await worker.build(submission.code, code_hash)
+        except BuildFailed as err:
+            await report_build_error(msg, err)
+            return "done"
+        await self.db.record_stages(
+            job_id, [("build", len(submission.code), monotonic() - start)]
+        )
+
+        try:
+            await benchmark(
+                msg,
+                self.db,
+                worker,
+                submission.code,
+                code_hash,
+                tag,
+                submission.day,
+                submission.part,
+                rerun is not None,
+                submission.approve,
+                job_id,
+                submission.parallel,
+                submission.profile,
+            )
+        finally:
+            await worker.release(tag)
+        return "done"
+
+    async def finish_job(
+        self, job_id: int, rerun: Optional[int], status: str = "done"
+    ) -> None:
+        self.active -= 1
+        await self.db.finish_job(job_id, status)
+        if rerun is not None:
+            rerun_status = await self.db.finish_rerun(rerun)
+            if rerun_status is None:
+                print(f"Rerun {rerun} is gone")
+            else:
+                print(f"Rerun {rerun} is {rerun_status}")
+            # makes room for another rerun, and failed ones may be pending again
+            self.reruns_planned.set()
+
+    async def fetch_message(
+        self, channel_id: int, message_id: int
+    ) -> Optional[discord.Message]:
+        if cached := discord.utils.get(self.cached_messages, id=message_id):
+            return cached
+
+        try:
+            channel = self.get_channel(channel_id) or await self.fetch_channel(
+                channel_id
+            )
+            assert isinstance(channel, discord.abc.Messageable)
+            return await channel.fetch_message(message_id)
+        except discord.HTTPException as err:
+            print(f"Failed to fetch message {message_id}: {err}")
+            return None
+
+    async def rerunner(self) -> None:
+        while True:
+            # cleared before looking, so a plan made meanwhile isn't missed
+            self.reruns_planned.clear()
+
+            # Only a few reruns are queued at a time, so that their attempts
+            # are tracked in rerun_jobs. Submissions go first either way.
+            while (
+                await self.db.read(lambda db: db.count_active_reruns()) < self.slots()
+            ):
+                target = await self.db.claim_rerun()
+                if target is None:
+                    break
+
+                rerun, channel, message = target
+                # reruns all take turns as user 0
+                await self.db.enqueue_job(0, channel, message, rerun_priority, rerun)
+                self.jobs_queued.set()
+
+            await self.reruns_planned.wait()
+
+    def idle(self) -> bool:
+        return not self.active and not any(worker.busy() for worker in self.workers)
+
+    async def maintainer(self) -> None:
+        while True:
+            await asyncio.sleep(maintenance_interval)
+
+            # maintenance would disturb benchmarks, and vice versa
+            while not self.idle():
+                await asyncio.sleep(60)
+
+            async with (
+                self.local.machine()
+                if self.local is not None
+                else contextlib.nullcontext()
+            ):
+                try:
+                    await self.db.write(lambda db: db.maintain())
+                except sqlite3.Error as err:
+                    print("Database maintenance failed:", err)
+
+    async def calibrator(self) -> None:
+        """Periodically checks every worker for drift, see `calibrate`."""
+        if calibration_interval() <= 0:
+            return
+
+        while True:
+            for worker in self.workers:
+                try:
+                    await calibrate(self.db, worker)
+                except (
+                    BuildFailed,
+                    RunFailed,
+                    ResultError,
+                    WorkerError,
+                    docker.errors.APIError,
+                ) as err:
+                    print(f"Calibration of {worker.name} failed: {err}")
+
+            await asyncio.sleep(calibration_interval())
 
     async def on_ready(self) -> None:
         print("Logged in as", self.user)
 
-        while True:
+        # on_ready fires again on reconnect, the workers are already running
+        if self.runners:
+            return
+
+        workers: list[Worker] = []
+        for worker in self.workers:
             try:
-                (msg, opt_code, opt_day, opt_part, rerun) = await self.queue.get()
-                if rerun:
-                    if (
-                        opt_code is not None
-                        and opt_day is not None
-                        and opt_part is not None
-                    ):
-                        await benchmark(msg, self.db, opt_code, opt_day, opt_part, True, False)
-
-                    await rerun_cmd(self, self.db, msg)
-                else:
-                    print(f"Processing request for {msg.author.name}")
-                    code = await msg.attachments[0].read()
-                    parts = [p for p in msg.content.split(" ") if p]
-
-                    if len(parts) < 2:
-                        await msg.reply(
-                            "Looks like you forgot to specify `<day> <part>`. Submit again, with a message like `4 2` if your code is for day 4 part 2."
-                        )
-                        continue
-
-                    day = int((parts[0:1] or (today(),))[0])
-                    part = int((parts[1:2] or (1,))[0])
-
-                    approve = (parts[2:3] or [""])[0] == "approve" and msg.author.id in [
-                        117530756263182344,  # iwearapot
-                        696196765564534825,  # bendn
-                        210141176211177474,  # noxim
-                    ]
-
-                    await benchmark(msg, self.db, code, day, part, False, approve)
-
-                self.queue.task_done()
-            except Exception as err:
-                print("Queue loop exception!", err)
+                await worker.prepare()
+            except WorkerError as err:
+                print(f"Leaving out worker: {err}")
+                continue
+
+            print(
+                f"Worker {worker.name}: {worker.hardware}, {worker.benchmarks} benchmarks at a time"
+            )
+            workers.append(worker)
+        self.workers = workers
+
+        if not self.workers:
+            print("Warning: no workers, jobs will stay queued")
+        print(f"Leaderboards show {self.hardware}")
+
+        def resume(db: Database) -> int:
+            db.adopt_runs(self.hardware)
+            queued = db.resume_jobs()
+            db.resume_reruns()
+            return queued
+
+        print(f"Resuming {await self.db.write(resume)} queued jobs")
+
+        self.runners = [
+            asyncio.create_task(self.runner(worker))
+            for worker in self.workers
+            for _ in range(worker.slots)
+        ]
+        self.migration = asyncio.create_task(migrate_code_blobs(self.db))
+        self.maintenance = asyncio.create_task(self.maintainer())
+        self.reruns = asyncio.create_task(self.rerunner())
+        self.calibration = asyncio.create_task(self.calibrator())
 
     async def on_message(self, msg: discord.Message) -> None:
         if msg.author.bot:
             return
 
         if msg.content.startswith("aoc"):
-            return await leaderboard_cmd(self, self.db, msg)
+            return await leaderboard_cmd(
+                self, self.db, self.user_names, self.hardware, msg
+            )
 
         if msg.content.startswith("best"):
-            return await best_cmd(self, self.db, msg)
+            return await best_cmd(self, self.db, self.user_names, self.hardware, msg)
+
+        if msg.content.startswith("queue"):
+            return await queue_cmd(self, self.db, msg)
 
         if msg.content.startswith("migrate-hash"):
             return await migrate_hash_cmd(self, self.db, msg)
@@ -899,7 +1388,14 @@ def main():
     assert token is not None, "No discord token passed"
 
     bot = MyBot(intents=intents)
-    bot.db = Database("database.db")
+    bot.db = AsyncDatabase("database.db")
+    bot.workers = list[Worker](remote_workers())
+    bot.local = None
+    if os.getenv("FERRIS_ELF_LOCAL_WORKER", "1") != "0":
+        bot.local = LocalWorker("local", builder_count)
+        bot.workers.insert(0, bot.local)
+    bot.hardware = leaderboard_hardware()
+    bot.user_names = UserNames(bot, bot.db, name_ttl())
     bot.run(token)
 
 
@@ -0,0 +1,233 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, TypeVar
+
+from .database import Database
+
+T = TypeVar("T")
+
+
+class AsyncDatabase:
+    """
+    Runs `Database` calls on worker threads so that queries never block the
+    event loop.
+
+    All writes go through a single connection on a dedicated writer thread,
+    and reads use read-only connections on a small pool of reader threads.
+    The database is in WAL mode, so readers don't wait for the writer.
+
+    Leaderboards are cached in memory until a write invalidates them.
+    """
+
+    __slots__ = (
+        "_file",
+        "_writer",
+        "_writer_db",
+        "_readers",
+        "_local",
+        "_scores",
+        "_best",
+        "_generation",
+    )
+
+    def __init__(self, file: str, readers: int = 2) -> None:
+        self._file = file
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix="db-writer")
+        self._readers = ThreadPoolExecutor(readers, thread_name_prefix="db-reader")
+        self._local = threading.local()
+
+        # Leaderboards by (day, part, hardware, parallel) and by (part,
+        # hardware, parallel). The generation is bumped on every
+        # invalidation, so that a read that raced with a write doesn't put
+        # outdated rows back into the cache.
+        self._scores: dict[
+            tuple[int, int, str, bool], list[tuple[Optional[str], Optional[int]]]
+        ] = {}
+        self._best: dict[
+            tuple[int, str, bool],
+            list[tuple[Optional[int], Optional[int], Optional[str], Optional[int]]],
+        ] = {}
+        self._generation = 0
+
+        # sqlite connections may only be used on the thread that created them.
+        # This also sets up the schema before any reader connects.
+        self._writer_db = self._writer.submit(Database, file).result()
+
+    def _on_reader(self, fn: Callable[[Database], T]) -> T:
+        db: Optional[Database] = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = Database(self._file, readonly=True)
+        return fn(db)
+
+    def _on_writer(self, fn: Callable[[Database], T]) -> T:
+        with self._writer_db as db:
+            return fn(db)
+
+    async def read(self, fn: Callable[[Database], T]) -> T:
+        """
+        Runs `fn` on a reader connection. Results must be fully consumed by
+        `fn`, cursors can't leave the reader thread.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._on_reader, fn)
+
+    async def write(
+        self, fn: Callable[[Database], T], invalidates: Optional[tuple[int, int]] = None
+    ) -> T:
+        """
+        Runs `fn` on the writer connection, and commits once it returns or
+        rolls back if it raises.
+        `invalidates` is the day and part whose runs or solutions `fn` changes.
+        """
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self._writer, self._on_writer, fn)
+        finally:
+            if invalidates is not None:
+                self.invalidate(*invalidates)
+
+    def invalidate(self, day: int, part: int) -> None:
+        """Drops the cached leaderboards that include `day` and `part`."""
+        self._generation += 1
+        for key in [key for key in self._scores if key[:2] == (day, part)]:
+            del self._scores[key]
+        for key in [key for key in self._best if key[0] == part]:
+            del self._best[key]
+
+    async def solutions_for(
+        self, day: int, part: int
+    ) -> list[tuple[Optional[int], Optional[int]]]:
+        return await self.read(lambda db: list(db.solutions_for(day, part)))
+
+    async def get_best(
+        self, day: int, part: int, user: int, hardware: str, parallel: bool
+    ) -> Optional[int]:
+        return await self.read(
+            lambda db: db.get_best(day, part, user, hardware, parallel)
+        )
+
+    async def get_scores_lb(
+        self, day: int, part: int, hardware: str, parallel: bool
+    ) -> list[tuple[Optional[str], Optional[int]]]:
+        key = (day, part, hardware, parallel)
+        if (cached := self._scores.get(key)) is not None:
+            return cached
+
+        generation = self._generation
+        rows = await self.read(
+            lambda db: list(db.get_scores_lb(day, part, hardware, parallel))
+        )
+        if generation == self._generation:
+            self._scores[key] = rows
+        return rows
+
+    async def get_best_lb(
+        self, part: int, hardware: str, parallel: bool
+    ) -> list[tuple[Optional[int], Optional[int], Optional[str], Optional[int]]]:
+        if (cached := self._best.get((part, hardware, parallel))) is not None:
+            return cached
+
+        generation = self._generation
+        rows = await self.read(
+            lambda db: list(db.get_best_lb(part, hardware, parallel))
+        )
+        if generation == self._generation:
+            self._best[(part, hardware, parallel)] = rows
+        return rows
+
+    async def get_answers(
+        self, keys: list[str], day: int, part: int
+    ) -> dict[str, Optional[str]]:
+        return await self.read(
+            lambda db: {key: db.get_answer(key, day, part) for key in keys}
+        )
+
+    async def get_code(self, code_hash: str) -> Optional[bytes]:
+        return await self.read(lambda db: db.get_code(code_hash))
+
+    async def get_runs_without_hash(
+        self, after: int
+    ) -> list[tuple[int, Optional[bytes]]]:
+        return await self.read(lambda db: db.get_runs_without_hash(after))
+
+    async def update_code_hashes(self, rows: list[tuple[int, str, bytes]]) -> None:
+        await self.write(lambda db: db.update_code_hashes(rows))
+
+    async def plan_reruns(self, channel: int, message: int) -> int:
+        return await self.write(lambda db: db.plan_reruns(channel, message))
+
+    async def rerun_counts(self) -> dict[str, int]:
+        return await self.read(lambda db: db.rerun_counts())
+
+    async def claim_rerun(self) -> Optional[tuple[int, int, int]]:
+        return await self.write(lambda db: db.claim_rerun())
+
+    async def get_rerun(
+        self, rerun_id: int
+    ) -> Optional[tuple[int, int, str, Optional[bytes], bool]]:
+        return await self.read(lambda db: db.get_rerun(rerun_id))
+
+    async def finish_rerun(self, job_id: int) -> Optional[str]:
+        return await self.write(lambda db: db.finish_rerun(job_id))
+
+    async def enqueue_job(
+        self,
+        user: int,
+        channel: int,
+        message: int,
+        priority: int,
+        rerun: Optional[int] = None,
+    ) -> int:
+        return await self.write(
+            lambda db: db.enqueue_job(user, channel, message, priority, rerun)
+        )
+
+    async def claim_job(self) -> Optional[tuple[int, int, int, Optional[int]]]:
+        return await self.write(lambda db: db.claim_job())
+
+    async def finish_job(self, job_id: int, status: str = "done") -> None:
+        await self.write(lambda db: db.finish_job(job_id, status))
+
+    async def requeue_job(self, job_id: int) -> None:
+        await self.write(lambda db: db.requeue_job(job_id))
+
+    async def queue_snapshot(
+        self,
+    ) -> list[tuple[int, str, Optional[float], Optional[int]]]:
+        return await self.read(lambda db: db.queue_snapshot())
+
+    async def stage_history(self) -> list[tuple[int, str, int, float]]:
+        return await self.read(lambda db: db.stage_history())
+
+    async def record_stages(
+        self, job_id: int, stages: list[tuple[str, int, float]]
+    ) -> None:
+        await self.write(lambda db: db.record_stages(job_id, stages))
+
+    async def record_calibration(
+        self,
+        worker: str,
+        hardware: str,
+        environment: str,
+        median: float,
+        tolerance: float,
+    ) -> Optional[float]:
+        return await self.write(
+            lambda db: db.record_calibration(
+                worker, hardware, environment, median, tolerance
+            )
+        )
+
+    async def get_user_names(self, users: list[int]) -> dict[int, tuple[str, int]]:
+        return await self.read(lambda db: db.get_user_names(users))
+
+    async def set_user_names(self, names: dict[int, str], fetched: int) -> None:
+        await self.write(lambda db: db.set_user_names(names, fetched))
+
+    async def insert_solution(
+        self, key: str, day: int, part: int, answer: str | int
+    ) -> None:
+        await self.write(
+            lambda db: db.insert_solution(key, day, part, answer), (day, part)
+        )
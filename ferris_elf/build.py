@@ -0,0 +1,281 @@
+import io
+import os
+import tarfile
+import threading
+import time
+from collections import Counter, OrderedDict
+from os.path import join
+from typing import Final, Optional
+
+import docker
+from blake3 import blake3
+
+runner_dir: Final = "runner"
+
+base_repository: Final = "ferris-elf-base"
+base_label: Final = "ferris-elf.base-fingerprint"
+
+cache_repository: Final = "ferris-elf-cache"
+cache_label: Final = "ferris-elf.cache-key"
+
+# Files of the runner build context that make up the base image. Changing any
+# of them results in a new base image and invalidates every cached build.
+context_files: Final = (
+    "Dockerfile",
+    "Cargo.toml",
+    "Cargo.lock",
+    "build.rs",
+    "profile.sh",
+    "nvidia_icd.json",
+    "src/main.rs",
+    "src/placeholder.rs",
+)
+
+# Submissions are layered on top of the base image, which already has every
+# dependency compiled, so the build context only has to carry the code itself.
+submission_dockerfile: Final = """FROM {base}
+COPY code.rs src/lib.rs
+RUN touch src/lib.rs
+RUN timeout 60 cargo build --release --offline
+"""
+
+
+def toolchain() -> str:
+    return os.getenv("FERRIS_ELF_TOOLCHAIN", "nightly")
+
+
+def runner_fingerprint() -> str:
+    hasher = blake3()
+    hasher.update(f"toolchain={toolchain()}".encode("utf-8"))
+    for name in context_files:
+        hasher.update(name.encode("utf-8"))
+        try:
+            with open(join(runner_dir, name), "rb") as f:
+                hasher.update(f.read())
+        except FileNotFoundError:
+            hasher.update(b"\0")
+    return hasher.hexdigest()
+
+
+def cache_key(code_hash: str, rustc: str) -> str:
+    """
+    `rustc` is the compiler version of the base image, see `rustc_version`.
+    Channels like `nightly` move, so the base image of the same fingerprint
+    can be rebuilt with another compiler.
+    """
+    return blake3(
+        f"{runner_fingerprint()}:{rustc}:{code_hash}".encode("utf-8")
+    ).hexdigest()
+
+
+def cache_tag(key: str) -> str:
+    return f"{cache_repository}:{key[:32]}"
+
+
+def base_tag(fingerprint: str) -> str:
+    return f"{base_repository}:{fingerprint[:32]}"
+
+
+_base_lock = threading.Lock()
+# `rustc -V` of each base image
+_base_rustc: dict[str, str] = {}
+
+
+def ensure_base(doc: docker.DockerClient, cpuset: Optional[str]) -> str:
+    """
+    Returns the tag of the base image for the current runner sources and
+    toolchain, building it first if it is missing or out of date.
+    """
+    fingerprint = runner_fingerprint()
+    tag = base_tag(fingerprint)
+    with _base_lock:
+        try:
+            image = doc.images.get(tag)
+            if image.labels.get(base_label) == fingerprint:
+                return tag
+            print(f"Base image {tag} is out of date")
+        except docker.errors.ImageNotFound:
+            pass
+
+        print(f"Building base image {tag}, this may take a while")
+        start = time.monotonic()
+        doc.images.build(
+            path=runner_dir,
+            tag=tag,
+            labels={base_label: fingerprint},
+            buildargs={"RUST_TOOLCHAIN": toolchain()},
+            container_limits={"cpusetcpus": cpuset} if cpuset else None,
+        )
+        print(f"Built base image {tag} in {time.monotonic() - start:.0f}s")
+
+        prune_bases(doc, fingerprint)
+    return tag
+
+
+def rustc_version(doc: docker.DockerClient, cpuset: Optional[str]) -> str:
+    """The compiler version of the current base image, e.g. `rustc 1.93.0-nightly (...)`."""
+    base = ensure_base(doc, cpuset)
+    with _base_lock:
+        if (version := _base_rustc.get(base)) is None:
+            out = doc.containers.run(
+                base, ["rustc", "-V"], remove=True, network_mode="none"
+            )
+            version = _base_rustc[base] = out.decode("utf-8").strip()
+            print(f"Base image {base} has {version}")
+    return version
+
+
+def prune_bases(doc: docker.DockerClient, current: str) -> None:
+    for image in doc.images.list(filters={"label": base_label}):
+        if image.labels.get(base_label) == current:
+            continue
+        try:
+            doc.images.remove(image.id)
+            print(f"Removed outdated base image {image.tags}")
+        except docker.errors.APIError as err:
+            # still has cached submissions built on top of it, these are
+            # unreachable now and will be evicted from the build cache
+            print(f"Keeping outdated base image {image.tags}: {err}")
+
+
+def build_context(base: str, solution: bytes) -> io.BytesIO:
+    context = io.BytesIO()
+    with tarfile.open(fileobj=context, mode="w") as tar:
+        for name, data in (
+            ("Dockerfile", submission_dockerfile.format(base=base).encode("utf-8")),
+            ("code.rs", solution),
+        ):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+    context.seek(0)
+    return context
+
+
+def build(
+    doc: docker.DockerClient,
+    solution: bytes,
+    key: str,
+    cpuset: Optional[str],
+) -> str:
+    """
+    Builds `solution` into the image `cache_tag(key)`. Every build sends its
+    own minimal context, so builds can run concurrently.
+    """
+    tag = cache_tag(key)
+    doc.images.build(
+        fileobj=build_context(ensure_base(doc, cpuset), solution),
+        custom_context=True,
+        tag=tag,
+        labels={cache_label: key},
+        container_limits={"cpusetcpus": cpuset} if cpuset else None,
+    )
+    return tag
+
+
+class BuildCache:
+    """
+    Content addressed cache of built benchmark images, keyed by `cache_key`.
+
+    Images are evicted in least recently used order once their combined
+    unshared size exceeds `budget` bytes. Sizes are tracked as images are
+    added, and only checked against `docker system df`, which is slow, once
+    the tracked total is over budget. `get` and `add` pin the image until
+    `unpin`, so images of jobs that are yet to be benchmarked are never
+    evicted. All methods talk to the docker daemon synchronously and should
+    be run in an executor.
+    """
+
+    __slots__ = "_doc", "_budget", "_entries", "_pinned", "_lock"
+
+    def __init__(self, doc: docker.DockerClient, budget: int) -> None:
+        self._doc = doc
+        self._budget = budget
+
+        # Recover cached images from a previous run, oldest first, so that
+        # eviction after a restart approximates the LRU order by build time.
+        # Sizes include layers shared with other images until `evict` runs.
+        self._entries = OrderedDict[str, int]()
+        images = doc.images.list(filters={"label": cache_label})
+        for image in sorted(images, key=lambda i: i.attrs["Created"]):
+            self._entries[image.labels[cache_label]] = image.attrs.get("Size", 0)
+        # jobs using each image
+        self._pinned = Counter[str]()
+        self._lock = threading.Lock()
+
+        print(f"Build cache holds {len(self._entries)} images")
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            self._pinned[key] += 1
+
+        tag = cache_tag(key)
+        try:
+            self._doc.images.get(tag)
+        except docker.errors.ImageNotFound:
+            # removed behind our back, e.g. by `docker image prune`
+            with self._lock:
+                self._entries.pop(key, None)
+                self._pinned[key] -= 1
+            return None
+        return tag
+
+    def add(self, key: str) -> None:
+        try:
+            size = self._doc.images.get(cache_tag(key)).attrs.get("Size", 0)
+        except docker.errors.ImageNotFound:
+            return
+
+        with self._lock:
+            self._entries[key] = size
+            self._entries.move_to_end(key)
+            self._pinned[key] += 1
+            over_budget = sum(self._entries.values()) > self._budget
+        if over_budget:
+            self.evict()
+
+    def unpin(self, tag: str) -> None:
+        """Lets the image `tag` be evicted again, once a job is done with it."""
+        with self._lock:
+            for key in self._pinned:
+                if cache_tag(key) == tag:
+                    self._pinned[key] -= 1
+                    break
+            self._pinned = +self._pinned
+
+    def evict(self) -> None:
+        sizes: dict[str, int] = {}
+        for image in self._doc.df().get("Images") or []:
+            key = (image.get("Labels") or {}).get(cache_label)
+            if key is not None:
+                sizes[key] = image["Size"] - max(image.get("SharedSize", 0), 0)
+
+        # held while removing, so an image can't be pinned meanwhile
+        with self._lock:
+            for key, size in sizes.items():
+                if key in self._entries:
+                    self._entries[key] = size
+            total = sum(self._entries.values())
+
+            for key in list(self._entries):
+                if total <= self._budget:
+                    break
+                if self._pinned[key] > 0:
+                    continue
+
+                try:
+                    self._doc.images.remove(cache_tag(key))
+                except docker.errors.APIError as err:
+                    print(f"Failed to evict {cache_tag(key)}: {err}")
+                    continue
+
+                print(f"Evicted {cache_tag(key)} from build cache")
+                total -= self._entries.pop(key)
+
+
+def default_budget() -> int:
+    return int(os.getenv("FERRIS_ELF_BUILD_CACHE_BYTES", str(64 * 1024**3)))
@@ -0,0 +1,242 @@
+import asyncio
+import contextlib
+import os
+from collections import Counter
+from typing import AsyncIterator, Iterable, NamedTuple, Optional
+
+
+def parse_cpuset(spec: str) -> set[int]:
+    """Parses a cpuset list such as `0-3,8,10-11`, as used by docker and sysfs."""
+    cpus = set[int]()
+    for chunk in spec.split(","):
+        chunk = chunk.strip()
+        if not chunk:
+            continue
+        if "-" in chunk:
+            start, end = chunk.split("-", 1)
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(chunk))
+    return cpus
+
+
+def format_cpuset(cpus: Iterable[int]) -> str:
+    runs: list[tuple[int, int]] = []
+    for cpu in sorted(set(cpus)):
+        if runs and runs[-1][1] == cpu - 1:
+            runs[-1] = (runs[-1][0], cpu)
+        else:
+            runs.append((cpu, cpu))
+    return ",".join(str(a) if a == b else f"{a}-{b}" for a, b in runs)
+
+
+def bench_cpus() -> str:
+    return os.getenv("FERRIS_ELF_BENCH_CPUS", "0-15")
+
+
+def build_cpus() -> str:
+    """
+    CPUs docker builds are pinned to. Defaults to every CPU of the host that is
+    not used for benchmarking, or the last physical core if there are none to
+    spare, which then isn't given to benchmark slots.
+    """
+    if spec := os.getenv("FERRIS_ELF_BUILD_CPUS"):
+        return spec
+
+    cpus = set(range(os.cpu_count() or 1))
+    spare = cpus - parse_cpuset(bench_cpus())
+    return format_cpuset(spare or core_threads(max(cpus)))
+
+
+def core_set(cpus: Iterable[int]) -> set[int]:
+    """`cpus` and the other hardware threads of their physical cores."""
+    return set[int]().union(*(core_threads(cpu) for cpu in cpus))
+
+
+sysfs_cpus = "/sys/devices/system/cpu"
+
+
+def read_cpuset(path: str) -> Optional[set[int]]:
+    try:
+        with open(path) as f:
+            return parse_cpuset(f.read())
+    except OSError:
+        return None
+
+
+def core_threads(cpu: int) -> set[int]:
+    """Hardware threads of the physical core `cpu` is on."""
+    return read_cpuset(f"{sysfs_cpus}/cpu{cpu}/topology/thread_siblings_list") or {cpu}
+
+
+def cache_domain(cpu: int) -> tuple[int, int]:
+    """
+    NUMA node of `cpu` and the lowest CPU sharing its last level cache.
+    CPUs in different domains don't compete for cache.
+    """
+    node = 0
+    try:
+        for entry in os.listdir(f"{sysfs_cpus}/cpu{cpu}"):
+            if entry.startswith("node") and entry[4:].isdigit():
+                node = int(entry[4:])
+    except OSError:
+        pass
+
+    shared = {cpu}
+    level = 0
+    try:
+        for index in os.listdir(f"{sysfs_cpus}/cpu{cpu}/cache"):
+            path = f"{sysfs_cpus}/cpu{cpu}/cache/{index}"
+            try:
+                with open(f"{path}/level") as f:
+                    index_level = int(f.read())
+            except (OSError, ValueError):
+                continue
+            if index_level > level and (cpus := read_cpuset(f"{path}/shared_cpu_list")):
+                level, shared = index_level, cpus
+    except OSError:
+        pass
+
+    return node, min(shared)
+
+
+def slot_cores() -> int:
+    """
+    Physical cores per benchmark slot. 0 gives every benchmark all of the
+    benchmark CPUs, one at a time.
+    """
+    return int(os.getenv("FERRIS_ELF_SLOT_CORES", "1"))
+
+
+class Slot(NamedTuple):
+    domain: tuple[int, int]
+    cpus: frozenset[int]
+
+
+def bench_slots(cpus: set[int], cores: int) -> list[Slot]:
+    """
+    Partitions `cpus` into slots of `cores` physical cores each, using one
+    thread per core so that SMT siblings stay idle. Slots don't span cache
+    domains, cores that don't fill a slot are left out.
+    """
+    if cores <= 0:
+        return []
+
+    # first thread in `cpus` of every physical core
+    firsts: dict[frozenset[int], int] = {}
+    for cpu in sorted(cpus):
+        firsts.setdefault(frozenset(core_threads(cpu)), cpu)
+
+    domains: dict[tuple[int, int], list[int]] = {}
+    for cpu in sorted(firsts.values()):
+        domains.setdefault(cache_domain(cpu), []).append(cpu)
+
+    slots: list[Slot] = []
+    for domain, domain_cpus in sorted(domains.items()):
+        for start in range(0, len(domain_cpus) - cores + 1, cores):
+            slots.append(Slot(domain, frozenset(domain_cpus[start : start + cores])))
+    return slots
+
+
+class CpuScheduler:
+    """
+    Hands out benchmark slots, so that independent benchmarks run side by
+    side on disjoint cores. Concurrent benchmarks are spread over cache
+    domains. A full machine reservation gets all of `full` once every slot
+    is free, and holds off new slot reservations while it waits.
+    """
+
+    __slots__ = (
+        "slots",
+        "full",
+        "_busy",
+        "_full",
+        "_full_waiting",
+        "_held",
+        "_changed",
+    )
+
+    def __init__(self, slots: list[Slot], full: str) -> None:
+        # without slots every benchmark gets the full machine
+        self.slots = slots or [Slot((0, 0), frozenset(parse_cpuset(full)))]
+        self.full = full
+        self._busy = set[Slot]()
+        self._full = False
+        self._full_waiting = 0
+        # reservations of other CPUs, which full reservations wait for
+        self._held = 0
+        self._changed = asyncio.Condition()
+
+    def busy(self) -> bool:
+        return bool(self._busy) or self._full
+
+    def _pick(self) -> Slot:
+        load = Counter(slot.domain for slot in self._busy)
+        return min(
+            (slot for slot in self.slots if slot not in self._busy),
+            key=lambda slot: (load[slot.domain], slot.domain, min(slot.cpus)),
+        )
+
+    @contextlib.asynccontextmanager
+    async def reserve(self, full: bool = False) -> AsyncIterator[str]:
+        """Reserves a slot, or the full machine, yielding its cpuset."""
+        slot = None
+        async with self._changed:
+            if full:
+                self._full_waiting += 1
+                try:
+                    await self._changed.wait_for(
+                        lambda: not self._busy and not self._full and not self._held
+                    )
+                finally:
+                    self._full_waiting -= 1
+                    self._changed.notify_all()
+                self._full = True
+            else:
+                await self._changed.wait_for(
+                    lambda: (
+                        not self._full
+                        and not self._full_waiting
+                        and len(self._busy) < len(self.slots)
+                    )
+                )
+                slot = self._pick()
+                self._busy.add(slot)
+
+        try:
+            yield self.full if slot is None else format_cpuset(slot.cpus)
+        finally:
+            async with self._changed:
+                if slot is None:
+                    self._full = False
+                else:
+                    self._busy.discard(slot)
+                self._changed.notify_all()
+
+    @contextlib.asynccontextmanager
+    async def reserve_cpus(self, cpus: set[int]) -> AsyncIterator[None]:
+        """
+        Reserves `cpus` for work that isn't a benchmark, such as builds. Only
+        waits for the slots that share a physical core with `cpus`, and for
+        full reservations, which get them next.
+        """
+        threads = core_set(cpus)
+        slots = {slot for slot in self.slots if not slot.cpus.isdisjoint(threads)}
+        async with self._changed:
+            await self._changed.wait_for(
+                lambda: (
+                    not self._full
+                    and not self._full_waiting
+                    and self._busy.isdisjoint(slots)
+                )
+            )
+            self._busy |= slots
+            self._held += 1
+
+        try:
+            yield
+        finally:
+            async with self._changed:
+                self._busy -= slots
+                self._held -= 1
+                self._changed.notify_all()
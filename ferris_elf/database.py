@@ -1,18 +1,141 @@
 import sqlite3
-from typing import Optional, Iterator, Self
+import statistics
+import time
+import zlib
+from array import array
+from typing import Optional, Iterator, Self, TypedDict
+
+
+class RunStats(TypedDict):
+    """Distribution of a run's samples, all times in nanoseconds."""
+
+    ci_low: float
+    ci_high: float
+    p5: float
+    p50: float
+    p95: float
+    # median absolute deviation from p50
+    mad: float
+    samples: list[int]
+
+
+class Counters(TypedDict):
+    """Average hardware event counts per run of a profile run."""
+
+    cycles: float
+    instructions: float
+    cache_references: float
+    cache_misses: float
+    branch_misses: float
+
+
+def pack_samples(samples: list[int]) -> bytes:
+    return zlib.compress(array("Q", samples).tobytes())
+
+
+def unpack_samples(blob: bytes) -> list[int]:
+    samples = array("Q")
+    samples.frombytes(zlib.decompress(blob))
+    return samples.tolist()
+
+
+def pack_code(code: bytes) -> tuple[bytes, bool]:
+    """Returns the stored form of `code`, and whether it is compressed."""
+    compressed = zlib.compress(code)
+    if len(compressed) < len(code):
+        return compressed, True
+    return code, False
+
+
+def unpack_code(blob: bytes, compressed: bool) -> bytes:
+    return zlib.decompress(blob) if compressed else blob
+
+
+# Runs that count towards the leaderboards: any run while a day has no
+# approved solution yet, and afterwards only verified runs. Runs flagged as
+# noisy are kept, but never count.
+_counts_sql = """(runs.noise IS NULL AND (runs.verified OR NOT EXISTS (
+    SELECT 1 FROM solutions WHERE solutions.day = runs.day AND solutions.part = runs.part
+)))"""
+
+# Version of what best_times holds, bumped to rebuild it from runs when
+# that changes
+_best_times_version = 2
+
+# Queued jobs with their place in line. A user's nth job goes after the
+# (n-1)th job of every other user with the same priority, counting the jobs
+# that are already running.
+_job_order_sql = """SELECT * FROM (
+    SELECT id, user, channel, message, rerun, priority, status,
+    ROW_NUMBER() OVER (PARTITION BY priority, user ORDER BY status = 'queued', id) AS turn
+    FROM jobs
+    WHERE status IN ('queued', 'running')
+) WHERE status = 'queued'"""
 
 
 class Database:
     __slots__ = "_db", "_cursor"
 
-    def __init__(self, file: str) -> None:
+    def __init__(self, file: str, readonly: bool = False) -> None:
+        if readonly:
+            # Additional read connection to a database that another connection
+            # has already set up
+            self._db = sqlite3.connect(f"file:{file}?mode=ro", uri=True)
+            self._cursor: None | sqlite3.Cursor = None
+            return
+
+        start = time.monotonic()
         db = sqlite3.connect(file)
 
         cur = db.cursor()
+        # Only takes effect for new databases, existing ones are converted by
+        # the first `maintain`
+        cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        # Readers don't block the writer and vice versa in WAL mode. The
+        # journal mode is persistent, synchronous has to be set per connection.
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+
         # Migration: ALTER TABLE runs ADD COLUMN timestamp INTEGER NOT NULL DEFAULT 0;
         # Migration: ALTER TABLE runs ADD COLUMN code_hash TEXT DEFAULT NULL;
         cur.execute("""CREATE TABLE IF NOT EXISTS runs 
-            (user TEXT, code TEXT, day INTEGER, part INTEGER, time REAL, answer INTEGER, answer2, timestamp INTEGER NOT NULL DEFAULT 0, code_hash TEXT DEFAULT NULL)""")
+            (user TEXT, code TEXT, day INTEGER, part INTEGER, time REAL, answer INTEGER, answer2, timestamp INTEGER NOT NULL DEFAULT 0, code_hash TEXT DEFAULT NULL,
+            ci_low REAL DEFAULT NULL, ci_high REAL DEFAULT NULL, samples INTEGER DEFAULT NULL,
+            p5 REAL DEFAULT NULL, p50 REAL DEFAULT NULL, p95 REAL DEFAULT NULL, mad REAL DEFAULT NULL, sample_times BLOB DEFAULT NULL,
+            verified INTEGER NOT NULL DEFAULT 0, hardware TEXT DEFAULT NULL, parallel INTEGER NOT NULL DEFAULT 0,
+            cycles REAL DEFAULT NULL, instructions REAL DEFAULT NULL, cache_references REAL DEFAULT NULL,
+            cache_misses REAL DEFAULT NULL, branch_misses REAL DEFAULT NULL,
+            environment TEXT DEFAULT NULL, noise TEXT DEFAULT NULL)""")
+        added = self._add_columns(
+            cur,
+            "runs",
+            ci_low="REAL DEFAULT NULL",
+            ci_high="REAL DEFAULT NULL",
+            samples="INTEGER DEFAULT NULL",
+            p5="REAL DEFAULT NULL",
+            p50="REAL DEFAULT NULL",
+            p95="REAL DEFAULT NULL",
+            mad="REAL DEFAULT NULL",
+            sample_times="BLOB DEFAULT NULL",
+            verified="INTEGER NOT NULL DEFAULT 0",
+            hardware="TEXT DEFAULT NULL",
+            parallel="INTEGER NOT NULL DEFAULT 0",
+            cycles="REAL DEFAULT NULL",
+            instructions="REAL DEFAULT NULL",
+            cache_references="REAL DEFAULT NULL",
+            cache_misses="REAL DEFAULT NULL",
+            branch_misses="REAL DEFAULT NULL",
+            environment="TEXT DEFAULT NULL",
+            noise="TEXT DEFAULT NULL",
+        )
+        # Migration: runs used to get every benchmark CPU
+        if "parallel" in added:
+            cur.execute("UPDATE runs SET parallel = 1")
+
+        # Submitted code, deduplicated by its blake3 hash. runs only keeps code
+        # inline for rows that don't have a code_hash yet.
+        cur.execute("""CREATE TABLE IF NOT EXISTS code_blobs
+            (code_hash TEXT PRIMARY KEY, code BLOB NOT NULL, compressed INTEGER NOT NULL)""")
         cur.execute("""CREATE TABLE IF NOT EXISTS solutions 
             (key TEXT, day INTEGER, part INTEGER, answer INTEGER, answer2)""")
 
@@ -21,27 +144,170 @@ class Database:
             "CREATE INDEX IF NOT EXISTS runs_index ON runs (day, part, user, time)"
         )
 
+        cur.execute("CREATE INDEX IF NOT EXISTS solutions_idx ON solutions (day, part)")
+        # Runs with a given answer, for verifying them when it is approved
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS runs_answer_index ON runs (day, part, answer2, time, user)"
+        )
+
+        # Migration: runs that match an approved solution are verified
+        if "verified" in added:
+            cur.execute("""UPDATE runs SET verified = EXISTS (
+                SELECT 1 FROM solutions
+                WHERE solutions.day = runs.day AND solutions.part = runs.part
+                AND solutions.answer2 = runs.answer2
+            )""")
+
+        # Reruns of stale runs (timestamp = 0), one per distinct code per day
+        # and part. `channel` and `message` are the rerun command that planned
+        # them, which progress is reported to.
+        cur.execute("""CREATE TABLE IF NOT EXISTS rerun_jobs
+            (id INTEGER PRIMARY KEY, day INTEGER NOT NULL, part INTEGER NOT NULL, code_hash TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0,
+            channel INTEGER NOT NULL, message INTEGER NOT NULL,
+            UNIQUE (day, part, code_hash))""")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS rerun_jobs_idx ON rerun_jobs (status, id)"
+        )
+
+        # Submissions and reruns waiting for or being benchmarked. Jobs run
+        # by priority, lowest first, and within a priority round robin by
+        # user. `channel` and `message` are the message that queued the job.
+        cur.execute("""CREATE TABLE IF NOT EXISTS jobs
+            (id INTEGER PRIMARY KEY, user TEXT NOT NULL, channel INTEGER NOT NULL, message INTEGER NOT NULL,
+            priority INTEGER NOT NULL, rerun INTEGER DEFAULT NULL, status TEXT NOT NULL DEFAULT 'queued',
+            created REAL NOT NULL, started REAL DEFAULT NULL, finished REAL DEFAULT NULL)""")
         cur.execute(
-            "CREATE INDEX IF NOT EXISTS solutions_idx ON solutions (day, part)"
+            "CREATE INDEX IF NOT EXISTS jobs_idx ON jobs (status, priority, user)"
         )
+        cur.execute("CREATE INDEX IF NOT EXISTS jobs_finished_idx ON jobs (finished)")
+        # How long each stage of a job took, see estimates.py
+        cur.execute("""CREATE TABLE IF NOT EXISTS job_stages
+            (job INTEGER NOT NULL, stage TEXT NOT NULL, size INTEGER NOT NULL, duration REAL NOT NULL)""")
+        cur.execute("CREATE INDEX IF NOT EXISTS job_stages_idx ON job_stages (job)")
+
+        # Names of users the client doesn't have cached, with the UNIX time
+        # they were fetched at
+        cur.execute("""CREATE TABLE IF NOT EXISTS user_names
+            (user TEXT PRIMARY KEY, name TEXT NOT NULL, fetched INTEGER NOT NULL)""")
+
+        # Median times of the calibration benchmark, see environment.py.
+        # Drifted times are kept, but left out of the baseline.
+        cur.execute("""CREATE TABLE IF NOT EXISTS calibrations
+            (worker TEXT NOT NULL, hardware TEXT NOT NULL, environment TEXT NOT NULL,
+            time REAL NOT NULL, created REAL NOT NULL, drifted INTEGER NOT NULL DEFAULT 0)""")
+        self._add_columns(cur, "calibrations", drifted="INTEGER NOT NULL DEFAULT 0")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS calibrations_idx ON calibrations (worker, hardware, environment, created)"
+        )
+
+        # Migration: best_times is derived from runs, so it is rebuilt with
+        # the hardware and parallel columns instead of adding them
+        if not {"hardware", "parallel"} <= {
+            row[1] for row in cur.execute("PRAGMA table_info(best_times)")
+        }:
+            cur.execute("DROP TABLE IF EXISTS best_times")
+            cur.execute("PRAGMA user_version = 0")
 
-        # run these on startup to clean up database
-        print("Running database maintenance tasks, this may take a while")
-        cur.execute("VACUUM")
-        cur.execute("ANALYZE")
+        # Each user's best time on each hardware class among the runs that
+        # count towards the leaderboards, kept up to date by every write to
+        # runs and solutions. Runs on one core and on every core are ranked
+        # separately.
+        cur.execute("""CREATE TABLE IF NOT EXISTS best_times
+            (day INTEGER, part INTEGER, user TEXT, hardware TEXT, parallel INTEGER NOT NULL DEFAULT 0,
+            time REAL, code_hash TEXT,
+            PRIMARY KEY (day, part, user, hardware, parallel))""")
+        cur.execute(
+            "CREATE INDEX IF NOT EXISTS best_times_hardware_idx ON best_times (hardware, parallel, part, day, time)"
+        )
+        # Migration: populate best_times from the existing runs. user_version
+        # records that this was done, best_times can stay empty afterwards.
+        if cur.execute("PRAGMA user_version").fetchone()[0] < _best_times_version:
+            print("Migrating best_times: computing best times from runs")
+            self._refresh_best_times(cur)
+            cur.execute(f"PRAGMA user_version = {_best_times_version}")
 
         db.commit()
 
         self._db = db
-        self._cursor: None | sqlite3.Cursor = None
+        self._cursor = None
+
+        print(f"Opened database in {(time.monotonic() - start) * 1000:.0f}ms")
+
+    @staticmethod
+    def _add_columns(cur: sqlite3.Cursor, table: str, **columns: str) -> set[str]:
+        """
+        Migration: adds any of `columns` that `table` was created without, and
+        returns their names.
+        """
+        existing = {row[1] for row in cur.execute(f"PRAGMA table_info({table})")}
+        added = set[str]()
+        for name, decl in columns.items():
+            if name not in existing:
+                print(f"Migrating {table}: adding column {name}")
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN {name} {decl}")
+                added.add(name)
+        return added
+
+    def maintain(self, analyze_threshold: float = 0.1) -> None:
+        """
+        Reclaims free pages and refreshes the query planner statistics. Tables
+        are only analyzed once their row count has changed by more than
+        `analyze_threshold` since the last ANALYZE.
+        """
+        start = time.monotonic()
+        # neither VACUUM nor ANALYZE of the schema can run in a transaction
+        self.commit()
+        cur = self._db.cursor()
+
+        if cur.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+            # Migration: databases created without incremental auto_vacuum
+            # need one last full VACUUM to switch
+            print(
+                "Converting database to incremental auto_vacuum, this may take a while"
+            )
+            cur.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            cur.execute("VACUUM")
+        elif free := cur.execute("PRAGMA freelist_count").fetchone()[0]:
+            # frees a page per step, so the result has to be consumed
+            cur.execute("PRAGMA incremental_vacuum").fetchall()
+            print(f"Freed {free} database pages")
+
+        has_stats = cur.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+        ).fetchone()
+        for table in ("runs", "solutions", "code_blobs", "best_times", "user_names"):
+            rows = cur.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+
+            # the first number of an index's stat is the table's row count
+            stat = (
+                has_stats
+                and cur.execute(
+                    "SELECT stat FROM sqlite_stat1 WHERE tbl = ? LIMIT 1", (table,)
+                ).fetchone()
+            )
+            analyzed = int(stat[0].split()[0]) if stat else 0
+
+            if abs(rows - analyzed) > analyze_threshold * analyzed:
+                print(f"Analyzing {table}, {analyzed} -> {rows} rows")
+                cur.execute(f"ANALYZE {table}")
+
+        cur.execute("PRAGMA optimize")
+        self.commit()
+
+        print(f"Database maintenance took {time.monotonic() - start:.1f}s")
 
     def __enter__(self) -> Self:
         self._cursor = self._db.cursor()
         return self
 
-    def __exit__(self, *_) -> None:
+    def __exit__(self, exc_type: Optional[type[BaseException]], *_) -> None:
         self._cursor = None
-        self.commit()
+        # a block that raised halfway leaves none of its writes behind
+        if exc_type is None:
+            self.commit()
+        else:
+            self._db.rollback()
 
     def commit(self) -> None:
         self._db.commit()
@@ -52,6 +318,41 @@ class Database:
         else:
             return self._db.cursor()
 
+    @staticmethod
+    def _refresh_best_times(
+        cur: sqlite3.Cursor,
+        day: Optional[int] = None,
+        part: Optional[int] = None,
+        code_hash: Optional[str] = None,
+    ) -> None:
+        """
+        Recomputes best_times from runs, for `day` and `part` if given, and
+        only for users that submitted `code_hash` if given.
+        """
+        where = "TRUE"
+        params: tuple[int | str, ...] = ()
+        if day is not None and part is not None:
+            where = "day = ? AND part = ?"
+            params = (day, part)
+            if code_hash is not None:
+                where += """ AND user IN (
+                    SELECT user FROM runs WHERE day = ? AND part = ? AND code_hash = ?
+                )"""
+                params += (day, part, code_hash)
+
+        cur.execute(f"DELETE FROM best_times WHERE {where}", params)
+        # SQLite takes code_hash from the row that has the MIN(time)
+        # runs from before hardware was recorded are left out until
+        # `adopt_runs` assigns them a class
+        cur.execute(
+            f"""INSERT INTO best_times (day, part, user, hardware, parallel, time, code_hash)
+            SELECT day, part, user, hardware, parallel, MIN(time), code_hash
+            FROM runs
+            WHERE {where} AND time IS NOT NULL AND hardware IS NOT NULL AND {_counts_sql}
+            GROUP BY day, part, user, hardware, parallel""",
+            params,
+        )
+
     def solutions_for(
         self, day: int, part: int
     ) -> Iterator[tuple[Optional[int], Optional[int]]]:
@@ -63,77 +364,176 @@ class Database:
             (day, part),
         )
 
-    def get_best(self, day: int, part: int, user: int) -> Optional[int]:
+    def get_best(
+        self, day: int, part: int, user: int, hardware: str, parallel: bool
+    ) -> Optional[int]:
         return next(
             self._get_cur().execute(
-                """SELECT MIN(time) FROM runs WHERE day = ? AND part = ? AND user = ? LIMIT 1""",
-                (day, part, user),
+                """SELECT MIN(time) FROM runs
+                WHERE day = ? AND part = ? AND user = ? AND hardware = ? AND parallel = ? LIMIT 1""",
+                (day, part, user, hardware, parallel),
             )
         )[0]
 
     def get_scores_lb(
-        self, day: int, part: int
+        self, day: int, part: int, hardware: str, parallel: bool
     ) -> Iterator[tuple[Optional[str], Optional[int]]]:
-        
-        if self._has_solution(day, part):
-            return self._get_cur().execute(
-                """SELECT runs.user, MIN(runs.time) FROM runs
-                INNER JOIN solutions ON solutions.day = runs.day AND solutions.part = runs.part AND solutions.answer2 = runs.answer2
-                WHERE runs.day = ? AND runs.part = ?
-                GROUP BY runs.user ORDER BY runs.time""",
-                (day, part),
-            )
-        else:
-            return self._get_cur().execute(
-                """SELECT user, MIN(time) FROM runs
-                WHERE day = ? AND part = ?
-                GROUP BY user ORDER BY time""",
-                (day, part),
-            )
+        return self._get_cur().execute(
+            """SELECT user, time FROM best_times
+            WHERE hardware = ? AND parallel = ? AND day = ? AND part = ?
+            ORDER BY time""",
+            (hardware, parallel, day, part),
+        )
 
     def get_best_lb(
-        self, part: int
+        self, part: int, hardware: str, parallel: bool
     ) -> Iterator[tuple[Optional[int], Optional[int], Optional[str], Optional[int]]]:
+        # only days with an approved solution, whose best_times are verified.
+        # Ties go to the lowest user id, so the leaderboard doesn't flip.
         return self._get_cur().execute(
-            """select runs.day, runs.part, user, min(time) from runs
-            inner join solutions on solutions.day = runs.day and solutions.part = runs.part
-            and solutions.answer2 = runs.answer2
-            where runs.part=?
-            group by runs.day, runs.part
-            order by runs.day, runs.part;""",
-            (part,),
-        )
-    
-    def _has_solution(self, day: int, part: int) -> bool:
+            """SELECT day, part, user, time FROM (
+                SELECT day, part, user, time,
+                ROW_NUMBER() OVER (PARTITION BY day ORDER BY time, user) AS rank
+                FROM best_times
+                WHERE hardware = ? AND parallel = ? AND part = ? AND EXISTS (
+                    SELECT 1 FROM solutions
+                    WHERE solutions.day = best_times.day AND solutions.part = best_times.part
+                )
+            )
+            WHERE rank = 1
+            ORDER BY day""",
+            (hardware, parallel, part),
+        )
+
+    def get_answer(self, key: str, day: int, part: int) -> Optional[str]:
         row = (
             self._get_cur()
             .execute(
-                "SELECT answer2 FROM solutions WHERE day = ? AND part = ?",
-                (day, part),
+                "SELECT answer2 FROM solutions WHERE key = ? AND day = ? AND part = ?",
+                (key, day, part),
             )
             .fetchone()
         )
 
         if row:
-            return True
+            return str(row[0]).strip()
         else:
-            return False
+            return None
 
-    def get_answer(self, key: str, day: int, part: int) -> Optional[str]:
+    def get_user_names(self, users: list[int]) -> dict[int, tuple[str, int]]:
+        """Stored names of `users`, with the time they were fetched at."""
+        if not users:
+            return {}
+
+        rows = self._get_cur().execute(
+            f"""SELECT user, name, fetched FROM user_names
+            WHERE user IN ({", ".join("?" * len(users))})""",
+            [str(user) for user in users],
+        )
+        return {int(user): (name, fetched) for user, name, fetched in rows}
+
+    def set_user_names(self, names: dict[int, str], fetched: int) -> None:
+        self._get_cur().executemany(
+            "INSERT OR REPLACE INTO user_names VALUES (?, ?, ?)",
+            [(str(user), name, fetched) for user, name in names.items()],
+        )
+
+    @staticmethod
+    def _stats_values(
+        stats: Optional[RunStats],
+    ) -> tuple[Optional[float | int | bytes], ...]:
+        if stats is None:
+            return (None,) * 8
+
+        return (
+            stats["ci_low"],
+            stats["ci_high"],
+            len(stats["samples"]),
+            stats["p5"],
+            stats["p50"],
+            stats["p95"],
+            stats["mad"],
+            pack_samples(stats["samples"]),
+        )
+
+    @staticmethod
+    def _counter_values(counters: Optional[Counters]) -> tuple[Optional[float], ...]:
+        if counters is None:
+            return (None,) * 5
+
+        return (
+            counters["cycles"],
+            counters["instructions"],
+            counters["cache_references"],
+            counters["cache_misses"],
+            counters["branch_misses"],
+        )
+
+    def _insert_code(self, code_hash: str, code: bytes) -> None:
+        self._get_cur().execute(
+            "INSERT OR IGNORE INTO code_blobs VALUES (?, ?, ?)",
+            (code_hash, *pack_code(code)),
+        )
+
+    def get_code(self, code_hash: str) -> Optional[bytes]:
         row = (
             self._get_cur()
             .execute(
-                "SELECT answer2 FROM solutions WHERE key = ? AND day = ? AND part = ?",
-                (key, day, part),
+                "SELECT code, compressed FROM code_blobs WHERE code_hash = ?",
+                (code_hash,),
             )
             .fetchone()
         )
 
         if row:
-            return str(row[0]).strip()
+            return unpack_code(row[0], row[1])
         else:
             return None
 
+    def migrate_code_blobs(self, after: int, limit: int = 256) -> Optional[int]:
+        """
+        Migration: moves the inline code of up to `limit` hashed runs with a
+        ROWID above `after` into code_blobs, and commits. Returns the last
+        ROWID that was looked at, or None once there are no runs left.
+        """
+        cur = self._get_cur()
+        rows = cur.execute(
+            """SELECT ROWID, code, code_hash
+            FROM runs
+            WHERE ROWID > ? AND code IS NOT NULL AND code_hash IS NOT NULL
+            ORDER BY ROWID
+            LIMIT ?""",
+            (after, limit),
+        ).fetchall()
+
+        if not rows:
+            return None
+
+        cur.executemany(
+            "INSERT OR IGNORE INTO code_blobs VALUES (?, ?, ?)",
+            [(code_hash, *pack_code(code)) for _, code, code_hash in rows],
+        )
+        cur.executemany(
+            "UPDATE runs SET code = NULL WHERE ROWID = ?",
+            [(row_id,) for row_id, _, _ in rows],
+        )
+        self.commit()
+
+        return rows[-1][0]
+
+    def insert_solution(self, key: str, day: int, part: int, answer: str | int) -> None:
+        cur = self._get_cur()
+        cur.execute(
+            "INSERT INTO solutions VALUES (?, ?, ?, ?, ?)",
+            (key, day, part, answer, answer),
+        )
+        cur.execute(
+            "UPDATE runs SET verified = 1 WHERE day = ? AND part = ? AND answer2 = ?",
+            (day, part, answer),
+        )
+        # runs with other answers stop counting once a day has a solution
+        self._refresh_best_times(cur, day, part)
+
     def insert_run(
         self,
         author_id: int,
@@ -144,12 +544,26 @@ class Database:
         answer: str,
         timestamp: int,
         code_hash: str,
+        hardware: str,
+        parallel: bool = False,
+        stats: Optional[RunStats] = None,
+        counters: Optional[Counters] = None,
+        environment: Optional[str] = None,
+        noise: Optional[str] = None,
     ):
-        self._get_cur().execute(
-            "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        self._insert_code(code_hash, code)
+        cur = self._get_cur()
+        cur.execute(
+            """INSERT INTO runs
+            (user, code, day, part, time, answer, answer2, timestamp, code_hash, hardware, parallel,
+            ci_low, ci_high, samples, p5, p50, p95, mad, sample_times,
+            cycles, instructions, cache_references, cache_misses, branch_misses,
+            environment, noise, verified)
+            VALUES (?, NULL, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, EXISTS (
+                SELECT 1 FROM solutions WHERE day = ? AND part = ? AND answer2 = ?
+            ))""",
             (
                 author_id,
-                code,
                 day,
                 part,
                 median,
@@ -157,8 +571,26 @@ class Database:
                 answer,
                 timestamp,
                 code_hash,
+                hardware,
+                parallel,
+                *self._stats_values(stats),
+                *self._counter_values(counters),
+                environment,
+                noise,
+                day,
+                part,
+                answer,
             ),
         )
+        cur.execute(
+            f"""INSERT INTO best_times (day, part, user, hardware, parallel, time, code_hash)
+            SELECT day, part, user, hardware, parallel, time, code_hash FROM runs
+            WHERE ROWID = ? AND time IS NOT NULL AND {_counts_sql}
+            ON CONFLICT (day, part, user, hardware, parallel) DO UPDATE
+            SET time = excluded.time, code_hash = excluded.code_hash
+            WHERE excluded.time < best_times.time""",
+            (cur.lastrowid,),
+        )
 
     def update_runs(
         self,
@@ -167,64 +599,402 @@ class Database:
         median: float,
         answer: str,
         code_hash: str,
+        hardware: str,
+        parallel: bool = False,
+        stats: Optional[RunStats] = None,
+        environment: Optional[str] = None,
+        noise: Optional[str] = None,
     ):
-        self._get_cur().execute(
+        cur = self._get_cur()
+        cur.execute(
             """UPDATE runs
-            SET time = ?, timestamp = 1
+            SET time = ?, hardware = ?, parallel = ?, ci_low = ?, ci_high = ?, samples = ?,
+            p5 = ?, p50 = ?, p95 = ?, mad = ?, sample_times = ?, environment = ?, noise = ?,
+            timestamp = 1
             WHERE timestamp = 0 AND day = ? AND part = ? AND answer = ? AND code_hash = ?""",
             (
                 median,
+                hardware,
+                parallel,
+                *self._stats_values(stats),
+                environment,
+                noise,
                 day,
                 part,
                 answer,
                 code_hash,
             ),
         )
+        # a rerun can be slower than before, so best times can't just be
+        # lowered like in insert_run
+        self._refresh_best_times(cur, day, part, code_hash)
+
+    def adopt_runs(self, hardware: str) -> int:
+        """
+        Migration: runs from before hardware was recorded were benchmarked on
+        `hardware`. Returns the number of runs adopted.
+        """
+        cur = self._get_cur()
+        adopted = cur.execute(
+            "UPDATE runs SET hardware = ? WHERE hardware IS NULL", (hardware,)
+        ).rowcount
+        if adopted:
+            print(f"Migrating runs: {adopted} runs were benchmarked on {hardware}")
+            self._refresh_best_times(cur)
+        return adopted
 
-    def get_runs_without_hash(self) -> Iterator[tuple[int, Optional[bytes]]]:
+    def get_run_stats(
+        self, day: int, part: int, user: int
+    ) -> Iterator[
+        tuple[
+            int, int, Optional[float], Optional[float], Optional[float], Optional[float]
+        ]
+    ]:
+        """ROWID, timestamp, median, p5, p95 and MAD of every run of a user, oldest first."""
         return self._get_cur().execute(
-            """SELECT ROWID,code
+            """SELECT ROWID, timestamp, time, p5, p95, mad
             FROM runs
-            WHERE code_hash IS NULL""",
+            WHERE day = ? AND part = ? AND user = ?
+            ORDER BY ROWID""",
+            (day, part, user),
         )
 
-    def update_code_hash(
-        self,
-        row_id: int,
-        code_hash: str,
-    ):
-        self._get_cur().execute(
+    def get_samples(self, row_id: int) -> Optional[list[int]]:
+        row = (
+            self._get_cur()
+            .execute("SELECT sample_times FROM runs WHERE ROWID = ?", (row_id,))
+            .fetchone()
+        )
+
+        if row and row[0] is not None:
+            return unpack_samples(row[0])
+        else:
+            return None
+
+    def count_runs_without_hash(self) -> int:
+        return (
+            self._get_cur()
+            .execute("SELECT COUNT(*) FROM runs WHERE code_hash IS NULL")
+            .fetchone()[0]
+        )
+
+    def get_runs_without_hash(
+        self, after: int, limit: int = 256
+    ) -> list[tuple[int, Optional[bytes]]]:
+        """Up to `limit` runs without a code_hash with a ROWID above `after`."""
+        return (
+            self._get_cur()
+            .execute(
+                """SELECT ROWID, code
+                FROM runs
+                WHERE ROWID > ? AND code_hash IS NULL
+                ORDER BY ROWID
+                LIMIT ?""",
+                (after, limit),
+            )
+            .fetchall()
+        )
+
+    def update_code_hashes(self, rows: list[tuple[int, str, bytes]]) -> None:
+        """Sets the code_hash of runs given as ROWID, code_hash and code."""
+        cur = self._get_cur()
+        cur.executemany(
+            "INSERT OR IGNORE INTO code_blobs VALUES (?, ?, ?)",
+            [(code_hash, *pack_code(code)) for _, code_hash, code in rows],
+        )
+        cur.executemany(
             """UPDATE runs
-            SET code_hash = ?
+            SET code_hash = ?, code = NULL
             WHERE ROWID = ?""",
-            (code_hash, row_id),
+            [(code_hash, row_id) for row_id, code_hash, _ in rows],
+        )
+        cur.executemany(
+            """UPDATE best_times SET code_hash = ?
+            WHERE code_hash IS NULL AND (day, part, user, time) = (
+                SELECT day, part, user, time FROM runs WHERE ROWID = ?
+            )""",
+            [(code_hash, row_id) for row_id, code_hash, _ in rows],
         )
 
-    def get_next_invalid_run(
-        self,
-    ) -> Optional[
-        tuple[
-            Optional[int], Optional[int], Optional[str], Optional[bytes], Optional[str]
-        ]
-    ]:
-        try:
-            # Order the result by random in case a run
-            # with invalid answers is encountered. This
-            # prevents it from blocking the rerun
-            # process.
-            return next(
-                self._get_cur().execute(
-                    """SELECT day, part, answer, code, code_hash
-                FROM (
-                    SELECT day, part, answer, code, code_hash
-                    FROM runs
-                    WHERE timestamp = 0
-                    GROUP BY day, part, answer, code_hash
-                    ORDER BY ROWID
-                )
-                ORDER BY RANDOM()
+    def plan_reruns(self, channel: int, message: int) -> int:
+        """
+        Queues a rerun of every code with stale runs, reporting to `message`.
+        Finished and failed reruns are queued again if their runs have gone
+        stale again since. Returns the number of pending reruns.
+        """
+        cur = self._get_cur()
+        cur.execute(
+            """INSERT INTO rerun_jobs (day, part, code_hash, channel, message)
+            SELECT DISTINCT day, part, code_hash, ?, ?
+            FROM runs
+            WHERE timestamp = 0 AND code_hash IS NOT NULL
+            ON CONFLICT (day, part, code_hash) DO UPDATE
+            SET status = 'pending', attempts = 0, channel = excluded.channel, message = excluded.message
+            WHERE rerun_jobs.status IN ('done', 'failed')""",
+            (channel, message),
+        )
+        return cur.execute(
+            "SELECT COUNT(*) FROM rerun_jobs WHERE status = 'pending'"
+        ).fetchone()[0]
+
+    def rerun_counts(self) -> dict[str, int]:
+        return dict(
+            self._get_cur().execute(
+                "SELECT status, COUNT(*) FROM rerun_jobs GROUP BY status"
+            )
+        )
+
+    def resume_reruns(self) -> None:
+        """
+        Requeues reruns that were interrupted by a restart, unless their job
+        is still queued. Run after `resume_jobs`.
+        """
+        self._get_cur().execute(
+            """UPDATE rerun_jobs SET status = 'pending'
+            WHERE status = 'running' AND id NOT IN (
+                SELECT rerun FROM jobs WHERE status = 'queued' AND rerun IS NOT NULL
+            )"""
+        )
+
+    def claim_rerun(self) -> Optional[tuple[int, int, int]]:
+        """
+        Marks the oldest pending rerun as running. Returns its id, and the
+        channel and message that planned it.
+        """
+        cur = self._get_cur()
+        row = cur.execute(
+            """SELECT id, channel, message
+            FROM rerun_jobs
+            WHERE status = 'pending'
+            ORDER BY id
+            LIMIT 1""",
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        cur.execute(
+            "UPDATE rerun_jobs SET status = 'running', attempts = attempts + 1 WHERE id = ?",
+            (row[0],),
+        )
+        return row
+
+    def get_rerun(
+        self, rerun_id: int
+    ) -> Optional[tuple[int, int, str, Optional[bytes], bool]]:
+        """
+        Day, part, code hash and code of a rerun, and whether it gets every
+        benchmark CPU like any of the runs it redoes.
+        """
+        cur = self._get_cur()
+        row = cur.execute(
+            "SELECT day, part, code_hash FROM rerun_jobs WHERE id = ?", (rerun_id,)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        day, part, code_hash = row
+        code = self.get_code(code_hash)
+        if code is None:
+            # not moved to code_blobs yet
+            inline = cur.execute(
+                """SELECT code FROM runs
+                WHERE day = ? AND part = ? AND code_hash = ? AND code IS NOT NULL
                 LIMIT 1""",
-                )
+                (day, part, code_hash),
+            ).fetchone()
+            code = inline[0] if inline else None
+
+        parallel = cur.execute(
+            """SELECT EXISTS (
+                SELECT 1 FROM runs
+                WHERE day = ? AND part = ? AND code_hash = ? AND timestamp = 0 AND parallel
+            )""",
+            (day, part, code_hash),
+        ).fetchone()[0]
+
+        return (day, part, code_hash, code, bool(parallel))
+
+    def finish_rerun(self, job_id: int, max_attempts: int = 3) -> Optional[str]:
+        """
+        Marks a rerun as done if none of its runs are stale anymore, and
+        otherwise as pending again until it has failed `max_attempts` times.
+        Returns the new status, or None if the rerun is gone.
+        """
+        row = (
+            self._get_cur()
+            .execute(
+                """UPDATE rerun_jobs SET status = CASE
+                    WHEN NOT EXISTS (
+                        SELECT 1 FROM runs
+                        WHERE runs.day = rerun_jobs.day AND runs.part = rerun_jobs.part
+                        AND runs.code_hash = rerun_jobs.code_hash AND runs.timestamp = 0
+                    ) THEN 'done'
+                    WHEN attempts >= ? THEN 'failed'
+                    ELSE 'pending'
+                END
+                WHERE id = ?
+                RETURNING status""",
+                (max_attempts, job_id),
             )
-        except StopIteration:
+            .fetchone()
+        )
+        return row[0] if row else None
+
+    def enqueue_job(
+        self,
+        user: int,
+        channel: int,
+        message: int,
+        priority: int,
+        rerun: Optional[int] = None,
+    ) -> int:
+        cur = self._get_cur()
+        cur.execute(
+            """INSERT INTO jobs (user, channel, message, priority, rerun, created)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (user, channel, message, priority, rerun, time.time()),
+        )
+        assert cur.lastrowid is not None
+        return cur.lastrowid
+
+    def claim_job(self) -> Optional[tuple[int, int, int, Optional[int]]]:
+        """
+        Marks the next queued job as running. Returns its id, channel,
+        message and rerun id.
+        """
+        cur = self._get_cur()
+        row = cur.execute(
+            f"""SELECT id, channel, message, rerun
+            FROM ({_job_order_sql})
+            ORDER BY priority, turn, id
+            LIMIT 1""",
+        ).fetchone()
+
+        if row is None:
             return None
+
+        cur.execute(
+            "UPDATE jobs SET status = 'running', started = ? WHERE id = ?",
+            (time.time(), row[0]),
+        )
+        return row
+
+    def finish_job(self, job_id: int, status: str = "done") -> None:
+        self._get_cur().execute(
+            "UPDATE jobs SET status = ?, finished = ? WHERE id = ?",
+            (status, time.time(), job_id),
+        )
+
+    def requeue_job(self, job_id: int) -> None:
+        """Puts a running job back in line, keeping its place."""
+        self._get_cur().execute(
+            "UPDATE jobs SET status = 'queued', started = NULL WHERE id = ?",
+            (job_id,),
+        )
+
+    def resume_jobs(self) -> int:
+        """Requeues jobs that were interrupted by a restart. Returns the number of queued jobs."""
+        cur = self._get_cur()
+        cur.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+        return cur.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status = 'queued'"
+        ).fetchone()[0]
+
+    def queue_snapshot(
+        self,
+    ) -> list[tuple[int, str, Optional[float], Optional[int]]]:
+        """
+        Running jobs and then queued jobs in order, as their id, user, start
+        time if running, and day if known.
+        """
+        cur = self._get_cur()
+        running = cur.execute(
+            """SELECT jobs.id, jobs.user, jobs.started, rerun_jobs.day
+            FROM jobs
+            LEFT JOIN rerun_jobs ON rerun_jobs.id = jobs.rerun
+            WHERE jobs.status = 'running'
+            ORDER BY jobs.started""",
+        ).fetchall()
+        queued = cur.execute(
+            f"""SELECT queue.id, queue.user, NULL, rerun_jobs.day
+            FROM ({_job_order_sql}) AS queue
+            LEFT JOIN rerun_jobs ON rerun_jobs.id = queue.rerun
+            ORDER BY queue.priority, queue.turn, queue.id""",
+        ).fetchall()
+        return running + queued
+
+    def record_stages(self, job_id: int, stages: list[tuple[str, int, float]]) -> None:
+        """Records the stage, size and duration in seconds of parts of a job."""
+        self._get_cur().executemany(
+            "INSERT INTO job_stages VALUES (?, ?, ?, ?)",
+            [(job_id, stage, size, duration) for stage, size, duration in stages],
+        )
+
+    def stage_history(self, jobs: int = 50) -> list[tuple[int, str, int, float]]:
+        """Job, stage, size and duration of the stages of the last `jobs` jobs."""
+        return (
+            self._get_cur()
+            .execute(
+                """SELECT job, stage, size, duration FROM job_stages
+                WHERE job IN (
+                    SELECT DISTINCT job FROM job_stages ORDER BY job DESC LIMIT ?
+                )""",
+                (jobs,),
+            )
+            .fetchall()
+        )
+
+    def record_calibration(
+        self,
+        worker: str,
+        hardware: str,
+        environment: str,
+        median: float,
+        tolerance: float,
+    ) -> Optional[float]:
+        """
+        Records a calibration time, returning the baseline it is compared to:
+        the median of the last 10 times of the same worker, hardware and
+        environment that didn't drift, if any. The time is marked drifted if
+        it is off the baseline by more than `tolerance`, relative to it.
+        """
+        cur = self._get_cur()
+        times = [
+            row[0]
+            for row in cur.execute(
+                """SELECT time FROM calibrations
+                WHERE worker = ? AND hardware = ? AND environment = ? AND NOT drifted
+                ORDER BY created DESC LIMIT 10""",
+                (worker, hardware, environment),
+            )
+        ]
+        baseline = statistics.median(times) if times else None
+        drifted = baseline is not None and abs(median / baseline - 1) > tolerance
+        cur.execute(
+            """INSERT INTO calibrations (worker, hardware, environment, time, created, drifted)
+            VALUES (?, ?, ?, ?, ?, ?)""",
+            (worker, hardware, environment, median, time.time(), drifted),
+        )
+        return baseline
+
+    def jobs_finished_since(self, since: float) -> int:
+        return (
+            self._get_cur()
+            .execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'done' AND finished > ?",
+                (since,),
+            )
+            .fetchone()[0]
+        )
+
+    def count_active_reruns(self) -> int:
+        return (
+            self._get_cur()
+            .execute(
+                """SELECT COUNT(*) FROM jobs
+                WHERE rerun IS NOT NULL AND status IN ('queued', 'running')"""
+            )
+            .fetchone()[0]
+        )
@@ -0,0 +1,175 @@
+import os
+import platform
+from typing import NamedTuple, Optional
+
+from .cpus import parse_cpuset, sysfs_cpus
+
+# Checked before every benchmark, see frequency.sh for how the benchmark
+# machine is meant to be set up
+
+
+def mode() -> str:
+    """
+    What to do about a noisy environment: `flag` runs anyway and marks the
+    run, which is stored but not ranked, `strict` puts the job back in line
+    for later, `off` doesn't check.
+    """
+    return os.getenv("FERRIS_ELF_ENVIRONMENT", "flag")
+
+
+def expected_governor() -> str:
+    return os.getenv("FERRIS_ELF_GOVERNOR", "performance")
+
+
+def disabled_idle_states() -> set[int]:
+    """Indices of the cpuidle states frequency.sh disables."""
+    return parse_cpuset(os.getenv("FERRIS_ELF_DISABLED_IDLE_STATES", "0-2"))
+
+
+def max_load() -> float:
+    """Highest 1 minute load average per CPU that isn't noisy."""
+    return float(os.getenv("FERRIS_ELF_MAX_LOAD", "1.0"))
+
+
+def max_temperature() -> float:
+    """Hottest thermal zone in °C that isn't noisy."""
+    return float(os.getenv("FERRIS_ELF_MAX_TEMPERATURE", "85"))
+
+
+class Environment(NamedTuple):
+    # Settings that affect times, runs are only comparable if these match
+    fingerprint: str
+    # Why the environment is noisy, if it is
+    issues: list[str]
+
+
+def read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def temperature() -> Optional[float]:
+    """Hottest thermal zone in °C."""
+    temps = []
+    try:
+        zones = os.listdir("/sys/class/thermal")
+    except OSError:
+        return None
+
+    for zone in zones:
+        value = read(f"/sys/class/thermal/{zone}/temp")
+        if zone.startswith("thermal_zone") and value is not None:
+            temps.append(int(value) / 1000)
+    return max(temps, default=None)
+
+
+def throttle_count(cpuset: str) -> int:
+    """Times the cores of `cpuset` were thermally throttled since boot."""
+    count = 0
+    for cpu in parse_cpuset(cpuset):
+        value = read(f"{sysfs_cpus}/cpu{cpu}/thermal_throttle/core_throttle_count")
+        count += int(value) if value else 0
+    return count
+
+
+def check(cpuset: str) -> Environment:
+    """
+    Checks the CPUs of `cpuset` before a benchmark. Settings the kernel
+    doesn't expose, e.g. in a VM, are left unchecked.
+    """
+    cpus = sorted(parse_cpuset(cpuset))
+    issues: list[str] = []
+
+    governors = {
+        governor
+        for cpu in cpus
+        if (governor := read(f"{sysfs_cpus}/cpu{cpu}/cpufreq/scaling_governor"))
+    }
+    if governors and governors != {expected_governor()}:
+        issues.append(
+            f"governor is {', '.join(sorted(governors))}, not {expected_governor()}"
+        )
+
+    frequencies = {
+        (
+            read(f"{sysfs_cpus}/cpu{cpu}/cpufreq/scaling_min_freq"),
+            read(f"{sysfs_cpus}/cpu{cpu}/cpufreq/scaling_max_freq"),
+        )
+        for cpu in cpus
+    }
+    if any(low != high for low, high in frequencies):
+        issues.append("frequency isn't pinned")
+
+    # acpi-cpufreq and amd-pstate have boost, intel_pstate has no_turbo
+    boost = read(f"{sysfs_cpus}/cpufreq/boost")
+    no_turbo = read(f"{sysfs_cpus}/intel_pstate/no_turbo")
+    boosting = boost == "1" or no_turbo == "0"
+    if boosting:
+        issues.append("boost is on")
+
+    enabled = set[str]()
+    for cpu in cpus:
+        for state in disabled_idle_states():
+            path = f"{sysfs_cpus}/cpu{cpu}/cpuidle/state{state}"
+            if read(f"{path}/disable") == "0":
+                enabled.add(read(f"{path}/name") or f"state{state}")
+    if enabled:
+        issues.append(f"idle states {', '.join(sorted(enabled))} are enabled")
+
+    load = os.getloadavg()[0]
+    if load > max_load() * (os.cpu_count() or 1):
+        issues.append(f"load average is {load:.1f}")
+
+    if (temp := temperature()) is not None and temp > max_temperature():
+        issues.append(f"CPU is at {temp:.0f}°C")
+
+    frequency = ",".join(
+        f"{low}-{high}" for low, high in sorted(frequencies, key=str) if low and high
+    )
+    fingerprint = " ".join(
+        [
+            f"governor={','.join(sorted(governors)) or '?'}",
+            f"freq={frequency or '?'}",
+            f"boost={'?' if boost is None and no_turbo is None else int(boosting)}",
+            f"idle={','.join(sorted(enabled)) or 'off'}",
+            f"kernel={platform.release()}",
+        ]
+    )
+    return Environment(fingerprint, issues)
+
+
+# Calibration benchmark, a fixed workload that is run periodically on every
+# worker. Its time only changes if the machine does.
+calibration_code = b"""pub fn run(input: &str) -> u64 {
+    let mut hash = 0xcbf2_9ce4_8422_2325u64;
+    let mut counts = [0u32; 256];
+    for line in input.lines() {
+        let value: u64 = line.parse().unwrap_or(0);
+        for byte in line.bytes() {
+            hash = (hash ^ byte as u64).wrapping_mul(0x100_0000_01b3);
+            counts[(hash >> 56) as usize] += 1;
+        }
+        if value % 3 == 0 {
+            hash = hash.rotate_left(7);
+        }
+    }
+    hash ^ counts.iter().map(|&c| c as u64).sum::<u64>()
+}
+"""
+
+
+def calibration_input() -> bytes:
+    return b"".join(b"%d\n" % (i * 7919 % 100_003) for i in range(20_000))
+
+
+def calibration_tolerance() -> float:
+    """Relative change of the calibration time that counts as drift."""
+    return float(os.getenv("FERRIS_ELF_CALIBRATION_TOLERANCE", "0.03"))
+
+
+def calibration_interval() -> int:
+    """Seconds between calibration runs on each worker, 0 to not calibrate."""
+    return int(os.getenv("FERRIS_ELF_CALIBRATION_INTERVAL", str(6 * 60 * 60)))
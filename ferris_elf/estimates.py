@@ -0,0 +1,105 @@
+import heapq
+import os
+from os.path import join
+from statistics import mean
+from typing import Optional
+
+from . import fetch
+
+# Stages recorded in job_stages, with what their size is:
+#  build: building the image, the length of the code
+#  input: benchmarking one input, the length of the input
+#  store: storing the results, the number of inputs
+
+
+def size_class(size: int) -> int:
+    """Inputs within a factor of two of each other take about as long."""
+    return size.bit_length()
+
+
+def input_sizes(day: int) -> Optional[list[int]]:
+    """Sizes of the inputs of `day`, or None if they haven't been fetched."""
+    path = fetch.get_day_input_dir(fetch.year, day)
+    try:
+        return [os.path.getsize(join(path, name)) for name in os.listdir(path)]
+    except OSError:
+        return None
+
+
+class Estimator:
+    """
+    Estimates how long jobs take from the stage durations of recent jobs,
+    as returned by `Database.stage_history`.
+    """
+
+    __slots__ = "_build", "_store", "_run", "_input", "_inputs"
+
+    def __init__(self, history: list[tuple[int, str, int, float]]) -> None:
+        builds: list[float] = []
+        stores: list[float] = []
+        runs: dict[int, float] = {}
+        inputs: list[float] = []
+        by_class: dict[int, list[float]] = {}
+
+        for job, stage, size, duration in history:
+            if stage == "build":
+                builds.append(duration)
+            elif stage == "store":
+                stores.append(duration)
+            elif stage == "input":
+                runs[job] = runs.get(job, 0) + duration
+                inputs.append(duration)
+                by_class.setdefault(size_class(size), []).append(duration)
+
+        self._build = mean(builds) if builds else None
+        self._store = mean(stores) if stores else 0
+        # whole benchmark of a job, for jobs whose day isn't known yet
+        self._run = mean(runs.values()) if runs else None
+        self._input = mean(inputs) if inputs else None
+        self._inputs = {cls: mean(durations) for cls, durations in by_class.items()}
+
+    def benchmark_time(self, sizes: Optional[list[int]] = None) -> Optional[float]:
+        """Seconds a job holds the benchmark machine, given its input sizes."""
+        if sizes is None or self._input is None:
+            run = self._run
+        else:
+            run = sum(self._inputs.get(size_class(size), self._input) for size in sizes)
+        return None if run is None else run + self._store
+
+    def job_time(self, sizes: Optional[list[int]] = None) -> Optional[float]:
+        """Seconds a job takes from being claimed to being stored."""
+        benchmark = self.benchmark_time(sizes)
+        if benchmark is None or self._build is None:
+            return None
+        return self._build + benchmark
+
+    def finish_times(
+        self,
+        queue: list[tuple[Optional[float], Optional[list[int]]]],
+        machines: int = 1,
+    ) -> list[Optional[float]]:
+        """
+        Seconds until each job of `queue` is finished on `machines` workers.
+        `queue` holds the seconds each running job has been running for, and
+        None for queued jobs, in order, along with their input sizes if known.
+        """
+        # Builds run alongside benchmarks, so jobs only wait for each other
+        # on the benchmark machines. Each job goes to the machine that is
+        # done first.
+        done = [0.0] * max(machines, 1)
+        etas: list[Optional[float]] = []
+        for running_for, sizes in queue:
+            benchmark = self.benchmark_time(sizes)
+            job = self.job_time(sizes)
+            if benchmark is None or job is None:
+                etas.append(None)
+                continue
+
+            finish = max(heapq.heappop(done) + benchmark, job - (running_for or 0))
+            heapq.heappush(done, finish)
+            etas.append(finish)
+        return etas
+
+    def stages(self) -> tuple[Optional[float], Optional[float], float]:
+        """Average build, benchmark and store time."""
+        return self._build, self._run, self._store
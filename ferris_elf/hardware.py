@@ -0,0 +1,35 @@
+import os
+import platform
+
+from .cpus import bench_cpus, parse_cpuset
+
+
+def cpu_model() -> str:
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key.strip() == "model name":
+                    return value.strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine() or "unknown CPU"
+
+
+def hardware_class(cpuset: str) -> str:
+    """
+    Hardware class of this machine when benchmarking on `cpuset`. Times are
+    only compared between runs of the same class. FERRIS_ELF_HARDWARE names
+    the class explicitly, e.g. to tell machines with the same CPU apart.
+    """
+    if name := os.getenv("FERRIS_ELF_HARDWARE"):
+        return name
+    return f"{cpu_model()}, {len(parse_cpuset(cpuset))} CPUs"
+
+
+def leaderboard_hardware() -> str:
+    """
+    Hardware class the leaderboards show. Defaults to the class of this
+    machine, runs on other classes are kept but not ranked.
+    """
+    return os.getenv("FERRIS_ELF_LEADERBOARD_HARDWARE") or hardware_class(bench_cpus())
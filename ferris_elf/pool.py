@@ -0,0 +1,244 @@
+import io
+import os
+import tarfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, NamedTuple, Optional
+
+import docker
+from docker.models.containers import Container
+
+pool_label = "ferris-elf.pool"
+
+# Where the harness is built in the base image, see runner/Dockerfile
+binary_path = "/usr/src/ferris-elf/target/release/ferris-elf"
+
+# Scratch directory of a job inside a pooled container, emptied after it.
+# docker can't copy files into a tmpfs, so it is a volume of the container.
+job_dir = "/job"
+
+# Jobs run as nobody, and can only write to results_dir and /dev/shm
+job_uid = 65534
+job_user = f"{job_uid}:{job_uid}"
+results_dir = f"{job_dir}/results"
+
+
+def pool_reuse() -> int:
+    """Jobs a container runs before it's replaced, 0 to not pool containers."""
+    return int(os.getenv("FERRIS_ELF_POOL_REUSE", "20"))
+
+
+class JobOutput(NamedTuple):
+    exit_code: int
+    stdout: bytes
+    stderr: bytes
+    # contents of results.json, if the harness wrote it
+    results: Optional[bytes]
+
+
+def _tar(files: dict[str, tuple[bytes, int]], writable: Iterable[str] = ()) -> bytes:
+    """
+    Archive of `files`, paths mapped to their contents and mode, and of the
+    directories `writable`, which belong to the job user.
+    """
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode="w") as tar:
+        for name in writable:
+            info = tarfile.TarInfo(name)
+            info.type = tarfile.DIRTYPE
+            info.mode = 0o755
+            info.uid = info.gid = job_uid
+            info.mtime = int(time.time())
+            tar.addfile(info)
+        for name, (data, mode) in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mode = mode
+            info.mtime = int(time.time())
+            tar.addfile(info, io.BytesIO(data))
+    return archive.getvalue()
+
+
+def _untar(chunks: Iterable[bytes]) -> bytes:
+    """Contents of the single file in a `get_archive` stream."""
+    with tarfile.open(fileobj=io.BytesIO(b"".join(chunks))) as tar:
+        member = tar.next()
+        f = tar.extractfile(member) if member is not None else None
+        if f is None:
+            raise tarfile.TarError("Archive has no file")
+        return f.read()
+
+
+class ContainerPool:
+    """
+    Started, network-less containers of the base image that submissions are
+    copied into and run with exec, instead of creating a container per run.
+
+    Idle containers are kept per cpuset. Jobs run as an unprivileged user on
+    a read-only root filesystem, and everything they can write to is emptied
+    after each job. A container is replaced after `reuse` jobs, and after
+    any job that fails or leaves a process behind, so jobs can't affect each
+    other. All methods talk to the docker daemon synchronously and should be
+    run in an executor.
+    """
+
+    __slots__ = "_doc", "_image", "_reuse", "_idle", "_uses", "_binaries", "_lock"
+
+    def __init__(self, doc: docker.DockerClient, reuse: int) -> None:
+        self._doc = doc
+        self._image: Optional[str] = None
+        self._reuse = reuse
+        self._idle: dict[str, list[Container]] = {}
+        self._uses: dict[str, int] = {}
+        # built harnesses by image tag, they are copied into every job
+        self._binaries = OrderedDict[str, bytes]()
+        self._lock = threading.Lock()
+
+    def prepare(self, image: str, cpusets: list[str]) -> None:
+        """
+        Removes containers left over from a previous run, and starts one
+        container of `image` for each of `cpusets`.
+        """
+        for container in self._doc.containers.list(
+            all=True, filters={"label": pool_label}
+        ):
+            self._remove(container)
+
+        with self._lock:
+            self._image = image
+            self._idle.clear()
+            self._uses.clear()
+
+        for cpuset in cpusets:
+            self._release(self._start(cpuset), cpuset)
+        print(f"Container pool started {len(cpusets)} containers of {image}")
+
+    def _start(self, cpuset: str) -> Container:
+        assert self._image is not None, "Container pool isn't prepared"
+        container = self._doc.containers.run(
+            self._image,
+            ["sleep", "infinity"],
+            detach=True,
+            init=True,
+            labels={pool_label: cpuset},
+            mem_limit="120g",
+            network_mode="none",
+            cpuset_cpus=cpuset,
+            user=job_user,
+            read_only=True,
+            mounts=[docker.types.Mount(job_dir, None, type="volume")],
+        )
+        with self._lock:
+            self._uses[container.id] = 0
+        return container
+
+    def _remove(self, container: Container) -> None:
+        with self._lock:
+            self._uses.pop(container.id, None)
+        try:
+            # along with its job volume
+            container.remove(force=True, v=True)
+        except docker.errors.APIError as err:
+            print(f"Failed to remove pooled container {container.short_id}: {err}")
+
+    def _acquire(self, cpuset: str) -> Container:
+        with self._lock:
+            if idle := self._idle.get(cpuset):
+                return idle.pop()
+        return self._start(cpuset)
+
+    def _release(self, container: Container, cpuset: str) -> None:
+        with self._lock:
+            self._idle.setdefault(cpuset, []).append(container)
+
+    def _binary(self, tag: str) -> bytes:
+        """The harness built into the image `tag`."""
+        with self._lock:
+            if (binary := self._binaries.get(tag)) is not None:
+                self._binaries.move_to_end(tag)
+                return binary
+
+        container = self._doc.containers.create(tag)
+        try:
+            chunks, _ = container.get_archive(binary_path)
+            binary = _untar(chunks)
+        finally:
+            container.remove(force=True)
+
+        with self._lock:
+            self._binaries[tag] = binary
+            while len(self._binaries) > 8:
+                self._binaries.popitem(last=False)
+        return binary
+
+    def run(
+        self,
+        tag: str,
+        cpuset: str,
+        inputs: list[str],
+        timeout: int,
+        environment: dict[str, str],
+    ) -> JobOutput:
+        """
+        Runs the harness built into `tag` on the input files `inputs`, in a
+        pooled container on `cpuset`. Inputs are named by their index, see
+        `stage_inputs` in workers.py.
+        """
+        # relative to job_dir, docker only copies into the volume on the
+        # read-only root filesystem
+        files = {"ferris-elf": (self._binary(tag), 0o755)}
+        for i, path in enumerate(inputs):
+            with open(path, "rb") as f:
+                files[f"inputs/{i}"] = (f.read(), 0o444)
+
+        container = self._acquire(cpuset)
+        healthy = False
+        try:
+            container.put_archive(
+                job_dir, _tar(files, [os.path.relpath(results_dir, job_dir)])
+            )
+            exit_code, (stdout, stderr) = container.exec_run(
+                ["timeout", str(timeout), f"{job_dir}/ferris-elf"],
+                environment=dict(
+                    FERRIS_ELF_INPUTS=f"{job_dir}/inputs",
+                    FERRIS_ELF_RESULTS=f"{results_dir}/results.json",
+                    **environment,
+                ),
+                workdir=job_dir,
+                user=job_user,
+                demux=True,
+            )
+
+            results = None
+            if exit_code == 0:
+                try:
+                    chunks, _ = container.get_archive(f"{results_dir}/results.json")
+                    results = _untar(chunks)
+                except (docker.errors.NotFound, tarfile.TarError):
+                    pass
+
+            # the job volume can't be removed itself, only emptied
+            cleanup = container.exec_run(
+                ["find", job_dir, "/dev/shm", "-mindepth", "1", "-delete"],
+                user="root",
+            )
+            # only the init process and `sleep` are left in a clean container
+            healthy = (
+                exit_code == 0
+                and cleanup.exit_code == 0
+                and len(container.top()["Processes"]) <= 2
+            )
+            return JobOutput(exit_code, stdout or b"", stderr or b"", results)
+        finally:
+            with self._lock:
+                uses = self._uses.get(container.id, 0) + 1
+                self._uses[container.id] = uses
+            if healthy and uses < self._reuse:
+                self._release(container, cpuset)
+            else:
+                self._remove(container)
+                try:
+                    self._release(self._start(cpuset), cpuset)
+                except docker.errors.APIError as err:
+                    print(f"Failed to replace pooled container: {err}")
@@ -0,0 +1,110 @@
+import json
+from statistics import median
+from typing import Any, NotRequired, TypedDict, cast
+
+# Version of the result record written by runner/src/main.rs
+version = 1
+
+
+class InputResult(TypedDict):
+    name: str
+    answer: str
+    # All times are in nanoseconds per run of the solution
+    median: int
+    average: int
+    min: int
+    max: int
+    p5: int
+    p95: int
+    # 95% confidence interval of the median
+    ci_low: int
+    ci_high: int
+    warmup_iterations: int
+    # Runs of the solution per sample
+    iterations: int
+    # Time spent sampling, excluding warmup
+    elapsed: int
+    # Average time per run of every batch, in the order they were taken
+    samples: list[int]
+    # Average hardware event counts per run, in profile runs on machines that
+    # have the counters. See `perf::EVENTS` in runner/src/main.rs.
+    counters: NotRequired[dict[str, float]]
+
+
+class ResultError(Exception):
+    __slots__ = ()
+
+
+_time_fields = (
+    "median",
+    "average",
+    "min",
+    "max",
+    "p5",
+    "p95",
+    "ci_low",
+    "ci_high",
+    "warmup_iterations",
+    "iterations",
+    "elapsed",
+)
+
+
+def _is_int(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def _is_number(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def check_result(result: Any) -> InputResult:
+    """Checks that `result` has the shape of an `InputResult`."""
+    if not isinstance(result, dict):
+        raise ResultError("Malformed input result")
+
+    for field in ("name", "answer"):
+        if not isinstance(result.get(field), str):
+            raise ResultError(f"Input result has no {field}")
+    for field in _time_fields:
+        if not _is_int(result.get(field)):
+            raise ResultError(f"Input result has no {field}")
+
+    samples = result.get("samples")
+    if not isinstance(samples, list) or not samples or not all(map(_is_int, samples)):
+        raise ResultError("Input result has no samples")
+
+    counters = result.get("counters")
+    if counters is not None and not (
+        isinstance(counters, dict)
+        and all(isinstance(k, str) and _is_number(v) for k, v in counters.items())
+    ):
+        raise ResultError("Malformed hardware counters")
+    return cast(InputResult, result)
+
+
+def parse_results(data: bytes) -> dict[str, InputResult]:
+    """Parses the runner's result record into the results of each input file."""
+    try:
+        record = json.loads(data)
+    except ValueError as e:
+        raise ResultError(f"Malformed result record: {e}")
+
+    if not isinstance(record, dict) or record.get("version") != version:
+        raise ResultError("Unsupported result record version")
+
+    inputs = record.get("inputs")
+    if not isinstance(inputs, list):
+        raise ResultError("Result record has no inputs")
+
+    results = {}
+    for entry in inputs:
+        result = check_result(entry)
+        result["answer"] = result["answer"].strip()
+        results[result["name"]] = result
+    return results
+
+
+def median_abs_deviation(result: InputResult) -> float:
+    center = result["median"]
+    return median(abs(sample - center) for sample in result["samples"])
@@ -0,0 +1,87 @@
+import asyncio
+import os
+import time
+from typing import Iterable
+
+import discord
+
+from .async_database import AsyncDatabase
+
+
+def name_ttl() -> int:
+    """Seconds a fetched user name is used for before it is fetched again."""
+    return int(os.getenv("FERRIS_ELF_USER_NAME_TTL", str(24 * 60 * 60)))
+
+
+class UserNames:
+    """
+    Resolves user ids to names for the leaderboards.
+
+    Users the client has cached are resolved directly. Other names are kept in
+    memory and in the database for `ttl` seconds, and the remaining misses are
+    fetched from the API concurrently.
+    """
+
+    __slots__ = "_bot", "_db", "_ttl", "_names"
+
+    def __init__(self, bot: discord.Client, db: AsyncDatabase, ttl: int) -> None:
+        self._bot = bot
+        self._db = db
+        self._ttl = ttl
+        # name and the UNIX time it was fetched at
+        self._names: dict[int, tuple[str, int]] = {}
+
+    def _fresh(self, user: int, now: int) -> bool:
+        entry = self._names.get(user)
+        return entry is not None and now - entry[1] < self._ttl
+
+    async def resolve(self, users: Iterable[int]) -> dict[int, str]:
+        """Names of `users`, leaving out users that couldn't be fetched."""
+        now = int(time.time())
+        names: dict[int, str] = {}
+
+        missing: list[int] = []
+        for user in dict.fromkeys(users):
+            if (userobj := self._bot.get_user(user)) is not None:
+                names[user] = userobj.name
+            elif self._fresh(user, now):
+                names[user] = self._names[user][0]
+            else:
+                missing.append(user)
+
+        if not missing:
+            return names
+
+        self._names.update(await self._db.get_user_names(missing))
+
+        fetch: list[int] = []
+        for user in missing:
+            if self._fresh(user, now):
+                names[user] = self._names[user][0]
+            else:
+                fetch.append(user)
+
+        if not fetch:
+            return names
+
+        results = await asyncio.gather(
+            *(self._bot.fetch_user(user) for user in fetch), return_exceptions=True
+        )
+
+        fetched: dict[int, str] = {}
+        for user, result in zip(fetch, results):
+            if isinstance(result, discord.User):
+                fetched[user] = result.name
+            elif user in self._names:
+                # better an outdated name than none
+                print(f"Failed to fetch user {user}, using stored name: {result}")
+                names[user] = self._names[user][0]
+            else:
+                print(f"Failed to fetch user {user}: {result}")
+
+        if fetched:
+            await self._db.set_user_names(fetched, now)
+            self._names.update((user, (name, now)) for user, name in fetched.items())
+            names.update(fetched)
+
+        return names
@@ -0,0 +1,624 @@
+import abc
+import asyncio
+import base64
+import contextlib
+import functools
+import hmac
+import json
+import os
+import shutil
+import tempfile
+from os.path import join
+from typing import Any, Optional
+
+import docker
+
+from .build import (
+    BuildCache,
+    build,
+    cache_key,
+    cache_repository,
+    default_budget,
+    ensure_base,
+    rustc_version,
+)
+from .cpus import (
+    CpuScheduler,
+    bench_cpus,
+    bench_slots,
+    build_cpus,
+    core_set,
+    format_cpuset,
+    parse_cpuset,
+    slot_cores,
+)
+from .environment import Environment, check, mode, throttle_count
+from .hardware import hardware_class
+from .pool import ContainerPool, pool_reuse
+from .results import InputResult, ResultError, check_result, parse_results
+
+# Adaptive benchmarking: sample until the 95% confidence interval of the
+# median is within this width relative to the median, after at least min_time
+# and at most max_time seconds. Set the width to 0 for a fixed 100 batches.
+bench_config = dict(
+    FERRIS_ELF_CI_WIDTH=os.getenv("FERRIS_ELF_CI_WIDTH", "0.01"),
+    FERRIS_ELF_MIN_TIME=os.getenv("FERRIS_ELF_MIN_TIME", "1"),
+    FERRIS_ELF_MAX_TIME=os.getenv("FERRIS_ELF_MAX_TIME", "10"),
+)
+
+# Longest line of the worker protocol, results carry every sample
+message_limit = 256 * 1024 * 1024
+
+
+class BuildFailed(Exception):
+    """The submission doesn't build, `log` is the build output."""
+
+    __slots__ = ("log",)
+
+    def __init__(self, message: str, log: str) -> None:
+        super().__init__(message)
+        self.log = log
+
+
+class RunFailed(Exception):
+    """The benchmark container exited with an error."""
+
+    __slots__ = ("stderr",)
+
+    def __init__(self, message: str, stderr: bytes) -> None:
+        super().__init__(message)
+        self.stderr = stderr
+
+
+class WorkerError(Exception):
+    """The worker failed for reasons unrelated to the submission."""
+
+    __slots__ = ()
+
+
+class Worker(abc.ABC):
+    """
+    A machine that builds and benchmarks submissions, running up to `slots`
+    jobs at a time, of which up to `benchmarks` are benchmarking on disjoint
+    CPUs. `hardware` is its hardware class, see hardware.py. `drift` is how
+    far its last calibration run was off, if it was.
+    """
+
+    __slots__ = "name", "hardware", "slots", "benchmarks", "drift"
+
+    def __init__(self, name: str, hardware: str, slots: int, benchmarks: int) -> None:
+        self.name = name
+        self.hardware = hardware
+        self.slots = slots
+        self.benchmarks = benchmarks
+        self.drift: Optional[float] = None
+
+    @abc.abstractmethod
+    async def build(self, code: bytes, code_hash: str) -> str:
+        """
+        Builds `code` into an image, returning its tag. The image is kept
+        until `release`.
+        """
+
+    async def release(self, tag: str) -> None:
+        """Lets the image `tag` go, once its job is done with it."""
+
+    @abc.abstractmethod
+    async def run(
+        self, tag: str, inputs: list[str], full: bool = False, profile: bool = False
+    ) -> tuple[dict[str, InputResult], Environment]:
+        """
+        Benchmarks the input files `inputs` in a single container, on a slot
+        of its own or on every benchmark CPU if `full`. Results are keyed by
+        the index of their input, which is all the container gets to see of
+        it. Profile runs also count hardware events where the machine allows
+        it. Also returns the environment the benchmark ran in, see
+        environment.py.
+        """
+
+    async def prepare(self) -> None:
+        """Gets the worker ready for jobs, raising `WorkerError` if it can't be."""
+
+    def busy(self) -> bool:
+        """Whether a benchmark is running on this machine."""
+        return False
+
+
+class LocalWorker(Worker):
+    """Builds and benchmarks with the docker daemon of this machine."""
+
+    __slots__ = (
+        "doc",
+        "build_cache",
+        "build_cpuset",
+        "bench_cpuset",
+        "shared_cpus",
+        "cpus",
+        "pool",
+    )
+
+    def __init__(self, name: str = "local", builders: int = 2) -> None:
+        self.doc = docker.from_env()
+        self.build_cache = BuildCache(self.doc, default_budget())
+        self.build_cpuset = build_cpus()
+        self.bench_cpuset = bench_cpus()
+        # Benchmarks never share cores. Slots are kept off the build cores,
+        # builds on benchmark CPUs only wait for full machine runs.
+        build_cores = core_set(parse_cpuset(self.build_cpuset))
+        bench = parse_cpuset(self.bench_cpuset)
+        self.shared_cpus = not build_cores.isdisjoint(bench)
+        self.cpus = CpuScheduler(
+            bench_slots(bench - build_cores, slot_cores()),
+            self.bench_cpuset,
+        )
+        self.pool = ContainerPool(self.doc, pool_reuse()) if pool_reuse() else None
+        benchmarks = len(self.cpus.slots)
+        super().__init__(
+            name,
+            hardware_class(self.bench_cpuset),
+            benchmarks + builders,
+            benchmarks,
+        )
+
+    def machine(
+        self, build: bool = False
+    ) -> contextlib.AbstractAsyncContextManager[object]:
+        """
+        Reserves every benchmark CPU, or for builds the build CPUs if they
+        are benchmark CPUs too.
+        """
+        if build:
+            if not self.shared_cpus:
+                return contextlib.nullcontext()
+            return self.cpus.reserve_cpus(parse_cpuset(self.build_cpuset))
+        return self.cpus.reserve(full=True)
+
+    def busy(self) -> bool:
+        return self.cpus.busy()
+
+    async def prepare(self) -> None:
+        """
+        Pays for a dependency change once at startup instead of on the first
+        submission.
+        """
+        if self.shared_cpus:
+            print(
+                f"Builds on CPUs {self.build_cpuset} wait for benchmarks that use every CPU"
+            )
+
+        print(
+            f"Benchmark slots: {', '.join(format_cpuset(slot.cpus) for slot in self.cpus.slots)}"
+        )
+
+        loop = asyncio.get_running_loop()
+        try:
+            base = await loop.run_in_executor(
+                None, ensure_base, self.doc, self.build_cpuset
+            )
+        except docker.errors.BuildError as err:
+            print(f"Failed to build base image: {err}")
+            self.pool = None
+            return
+
+        if self.pool is not None:
+            # a container for every slot and one for full machine runs
+            cpusets = [format_cpuset(slot.cpus) for slot in self.cpus.slots]
+            cpusets = list(dict.fromkeys([*cpusets, self.bench_cpuset]))
+            try:
+                await loop.run_in_executor(None, self.pool.prepare, base, cpusets)
+            except docker.errors.APIError as err:
+                print(f"Failed to start container pool: {err}")
+                self.pool = None
+
+    async def build(self, code: bytes, code_hash: str) -> str:
+        loop = asyncio.get_running_loop()
+
+        rustc = await loop.run_in_executor(
+            None, rustc_version, self.doc, self.build_cpuset
+        )
+        key = cache_key(code_hash, rustc)
+        cached = await loop.run_in_executor(None, self.build_cache.get, key)
+        if cached is not None:
+            print(f"Reusing {cached}")
+            return cached
+
+        async with self.machine(build=True):
+            try:
+                tag = await loop.run_in_executor(
+                    None,
+                    functools.partial(build, self.doc, code, key, self.build_cpuset),
+                )
+            except docker.errors.BuildError as err:
+                print(f"Build error: {err}")
+                log = "".join(chunk.get("stream") or "" for chunk in err.build_log)
+                raise BuildFailed(str(err), log)
+
+        await loop.run_in_executor(None, self.build_cache.add, key)
+        return tag
+
+    async def release(self, tag: str) -> None:
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.build_cache.unpin, tag
+        )
+
+    async def run(
+        self, tag: str, inputs: list[str], full: bool = False, profile: bool = False
+    ) -> tuple[dict[str, InputResult], Environment]:
+        async with self.cpus.reserve(full) as cpuset:
+            environment = check(cpuset)
+            if mode() == "off":
+                environment.issues.clear()
+            elif environment.issues and mode() == "strict":
+                raise WorkerError(
+                    f"Noisy environment on {self.name}: {'; '.join(environment.issues)}"
+                )
+            throttled = throttle_count(cpuset)
+
+            # profile runs need capabilities that pooled containers don't have
+            if self.pool is not None and not profile:
+                results = await self.run_pooled(tag, cpuset, inputs)
+            else:
+                results = await self.run_container(tag, cpuset, inputs, profile)
+
+            if mode() != "off" and throttle_count(cpuset) > throttled:
+                if mode() == "strict":
+                    raise WorkerError(f"{self.name} was throttled during a run")
+                environment.issues.append("CPU was throttled during the run")
+            return results, environment
+
+    async def run_pooled(
+        self, tag: str, cpuset: str, inputs: list[str]
+    ) -> dict[str, InputResult]:
+        """Runs the harness in a warm container of the pool, see pool.py."""
+        assert self.pool is not None
+        try:
+            output = await asyncio.get_running_loop().run_in_executor(
+                None,
+                functools.partial(
+                    self.pool.run, tag, cpuset, inputs, 180 * len(inputs), bench_config
+                ),
+            )
+        except docker.errors.APIError as err:
+            raise WorkerError(f"Container pool of {self.name} failed: {err}")
+        print(output.stdout.decode("utf-8", errors="replace"))
+
+        if output.exit_code != 0:
+            print(f"Run error: exit code {output.exit_code}")
+            raise RunFailed(
+                f"Benchmark exited with status {output.exit_code}", output.stderr
+            )
+        if output.results is None:
+            raise ResultError("Benchmark wrote no results")
+        return parse_results(output.results)
+
+    async def run_container(
+        self, tag: str, cpuset: str, inputs: list[str], profile: bool
+    ) -> dict[str, InputResult]:
+        """Runs a container of its own, for when the pool can't be used."""
+        loop = asyncio.get_running_loop()
+        with (
+            tempfile.TemporaryDirectory(prefix="ferris-elf-inputs-") as input_dir,
+            tempfile.TemporaryDirectory(prefix="ferris-elf-results-") as results_dir,
+        ):
+            await loop.run_in_executor(None, stage_inputs, inputs, input_dir)
+            try:
+                out = await loop.run_in_executor(
+                    None,
+                    functools.partial(
+                        self.doc.containers.run,
+                        tag,
+                        f"timeout {180 * len(inputs)} ./profile.sh",
+                        environment=dict(
+                            FERRIS_ELF_INPUTS="/inputs",
+                            FERRIS_ELF_RESULTS="/results/results.json",
+                            **bench_config,
+                            **({"FERRIS_ELF_PROFILE": "1"} if profile else {}),
+                        ),
+                        volumes={
+                            os.path.abspath(input_dir): {
+                                "bind": "/inputs",
+                                "mode": "ro",
+                            },
+                            results_dir: {"bind": "/results", "mode": "rw"},
+                        },
+                        remove=True,
+                        stdout=True,
+                        mem_limit="120g",
+                        network_mode="none",
+                        cpuset_cpus=cpuset,
+                        # lets docker's seccomp profile allow perf_event_open
+                        cap_add=["PERFMON"] if profile else None,
+                    ),
+                )
+            except docker.errors.ContainerError as err:
+                print(f"Run error: {err}")
+                raise RunFailed(str(err), err.stderr or b"")
+            except docker.errors.APIError as err:
+                # e.g. the image was removed behind our back, building it
+                # again on the next attempt fixes that
+                raise WorkerError(f"Failed to run {tag} on {self.name}: {err}")
+            print(out.decode("utf-8", errors="replace"))
+
+            try:
+                data = await loop.run_in_executor(
+                    None, read_file, join(results_dir, "results.json")
+                )
+            except OSError as err:
+                raise ResultError(str(err))
+            return parse_results(data)
+
+
+def read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def stage_inputs(inputs: list[str], input_dir: str) -> None:
+    """
+    Copies `inputs` into `input_dir` named by their index. Input files are
+    named by the AoC session token they were fetched with, which submissions
+    must never see.
+    """
+    for i, path in enumerate(inputs):
+        shutil.copyfile(path, join(input_dir, str(i)))
+
+
+def read_inputs(inputs: list[str]) -> list[str]:
+    """`inputs` base64 encoded for the worker protocol, in order."""
+    return [base64.b64encode(read_file(path)).decode("ascii") for path in inputs]
+
+
+def write_inputs(input_dir: str, inputs: list[str]) -> list[str]:
+    """Writes inputs of the worker protocol to files, returning their paths."""
+    paths = []
+    for i, data in enumerate(inputs):
+        paths.append(join(input_dir, str(i)))
+        with open(paths[-1], "wb") as f:
+            f.write(base64.b64decode(data))
+    return paths
+
+
+def check_environment(environment: Any) -> Environment:
+    if not (
+        isinstance(environment, dict)
+        and isinstance(environment.get("fingerprint"), str)
+        and isinstance(environment.get("issues"), list)
+        and all(isinstance(issue, str) for issue in environment["issues"])
+    ):
+        raise ResultError("Malformed environment")
+    return Environment(environment["fingerprint"], environment["issues"])
+
+
+class RemoteWorker(Worker):
+    """
+    A worker daemon on another machine, see `serve`. Every call is a single
+    JSON line request and response over a fresh TCP connection. Nothing on
+    the connection is encrypted, so it should be tunneled, e.g. over SSH.
+    """
+
+    __slots__ = "host", "port", "_token"
+
+    def __init__(self, host: str, port: int, token: str) -> None:
+        super().__init__(f"{host}:{port}", "unknown", 1, 1)
+        self.host = host
+        self.port = port
+        self._token = token
+
+    async def _call(self, request: dict[str, Any]) -> dict[str, Any]:
+        try:
+            reader, writer = await asyncio.open_connection(
+                self.host, self.port, limit=message_limit
+            )
+            try:
+                request["token"] = self._token
+                writer.write(json.dumps(request).encode("utf-8") + b"\n")
+                await writer.drain()
+                line = await reader.readline()
+            finally:
+                writer.close()
+        except (OSError, ValueError) as err:
+            raise WorkerError(f"Worker {self.name} is unreachable: {err}")
+
+        try:
+            response = json.loads(line)
+        except ValueError:
+            raise WorkerError(f"Worker {self.name} sent no valid response")
+        if not isinstance(response, dict):
+            raise WorkerError(f"Worker {self.name} sent no valid response")
+
+        error = response.get("error")
+        message = response.get("message")
+        match error:
+            case None:
+                return response
+            case "build" if isinstance(message, str) and isinstance(
+                log := response.get("log"), str
+            ):
+                raise BuildFailed(message, log)
+            case "run" if isinstance(message, str) and isinstance(
+                stderr := response.get("stderr"), str
+            ):
+                try:
+                    output = base64.b64decode(stderr, validate=True)
+                except ValueError:
+                    raise WorkerError(f"Worker {self.name} sent malformed stderr")
+                raise RunFailed(message, output)
+            case "result" if isinstance(message, str):
+                raise ResultError(message)
+            case "build" | "run" | "result":
+                raise WorkerError(f"Worker {self.name} sent a malformed {error} error")
+            case _:
+                raise WorkerError(f"Worker {self.name}: {message}")
+
+    async def prepare(self) -> None:
+        """Asks the daemon for its name, hardware class and slots."""
+        hello = await self._call({"op": "hello"})
+        if not (
+            isinstance(hello.get("name"), str)
+            and isinstance(hello.get("hardware"), str)
+            and all(
+                type(hello.get(key)) is int and hello[key] > 0
+                for key in ("slots", "benchmarks")
+            )
+        ):
+            raise WorkerError(f"Worker {self.name} sent a malformed hello")
+        self.name = f"{hello['name']} ({self.host}:{self.port})"
+        self.hardware = hello["hardware"]
+        self.slots = hello["slots"]
+        self.benchmarks = hello["benchmarks"]
+
+    async def build(self, code: bytes, code_hash: str) -> str:
+        response = await self._call(
+            {
+                "op": "build",
+                "code": base64.b64encode(code).decode("ascii"),
+                "code_hash": code_hash,
+            }
+        )
+        if not isinstance(tag := response.get("tag"), str):
+            raise WorkerError(f"Worker {self.name} sent no image tag")
+        return tag
+
+    async def release(self, tag: str) -> None:
+        try:
+            await self._call({"op": "release", "tag": tag})
+        except WorkerError as err:
+            print(f"Failed to release {tag}: {err}")
+
+    async def run(
+        self, tag: str, inputs: list[str], full: bool = False, profile: bool = False
+    ) -> tuple[dict[str, InputResult], Environment]:
+        encoded = await asyncio.get_running_loop().run_in_executor(
+            None, read_inputs, inputs
+        )
+
+        response = await self._call(
+            {
+                "op": "run",
+                "tag": tag,
+                "inputs": encoded,
+                "full": full,
+                "profile": profile,
+            }
+        )
+
+        # the daemon is trusted with the token, not with what reaches the
+        # database unchecked
+        results = response.get("results")
+        if not isinstance(results, dict):
+            raise ResultError(f"Worker {self.name} sent no results")
+        checked = {}
+        for name, result in results.items():
+            checked[name] = check_result(result)
+            if checked[name]["name"] != name:
+                raise ResultError(f"Worker {self.name} mixed up results")
+        return checked, check_environment(response.get("environment"))
+
+
+def remote_workers() -> list[RemoteWorker]:
+    """Worker daemons listed in FERRIS_ELF_WORKERS as `host:port,host:port`."""
+    token = os.getenv("FERRIS_ELF_WORKER_TOKEN", "")
+    workers = []
+    for address in os.getenv("FERRIS_ELF_WORKERS", "").split(","):
+        if address := address.strip():
+            host, _, port = address.rpartition(":")
+            workers.append(RemoteWorker(host, int(port), token))
+    return workers
+
+
+async def handle_request(
+    worker: LocalWorker, token: str, request: dict[str, Any]
+) -> dict[str, Any]:
+    if not hmac.compare_digest(str(request.get("token", "")), token):
+        return {"error": "auth", "message": "Invalid token"}
+
+    try:
+        match request.get("op"):
+            case "hello":
+                return {
+                    "name": worker.name,
+                    "hardware": worker.hardware,
+                    "slots": worker.slots,
+                    "benchmarks": worker.benchmarks,
+                }
+            case "build":
+                code = base64.b64decode(request["code"])
+                print(f"Building {request['code_hash']}")
+                return {"tag": await worker.build(code, request["code_hash"])}
+            case "release":
+                await worker.release(request["tag"])
+                return {}
+            case "run":
+                # only images this worker built itself
+                tag = request["tag"]
+                if not tag.startswith(f"{cache_repository}:"):
+                    return {"error": "worker", "message": f"Not a build: {tag}"}
+
+                print(f"Running {tag}")
+                with tempfile.TemporaryDirectory(prefix="ferris-elf-inputs-") as path:
+                    inputs = await asyncio.get_running_loop().run_in_executor(
+                        None, write_inputs, path, request["inputs"]
+                    )
+                    results, environment = await worker.run(
+                        tag,
+                        inputs,
+                        bool(request.get("full")),
+                        bool(request.get("profile")),
+                    )
+                    return {
+                        "results": results,
+                        "environment": environment._asdict(),
+                    }
+            case op:
+                return {"error": "worker", "message": f"Unknown op {op}"}
+    except BuildFailed as err:
+        return {"error": "build", "message": str(err), "log": err.log}
+    except RunFailed as err:
+        return {
+            "error": "run",
+            "message": str(err),
+            "stderr": base64.b64encode(err.stderr).decode("ascii"),
+        }
+    except ResultError as err:
+        return {"error": "result", "message": str(err)}
+
+
+async def serve(worker: LocalWorker, host: str, port: int, token: str) -> None:
+    """Runs a worker daemon that builds and benchmarks for the bot."""
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            response = await handle_request(
+                worker, token, json.loads(await reader.readline())
+            )
+        except Exception as err:
+            print("Worker request exception!", err)
+            response = {"error": "worker", "message": str(err)}
+
+        try:
+            writer.write(json.dumps(response).encode("utf-8") + b"\n")
+            await writer.drain()
+        finally:
+            writer.close()
+
+    await worker.prepare()
+    server = await asyncio.start_server(handle, host, port, limit=message_limit)
+    print(f"Worker {worker.name} ({worker.hardware}) listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+
+def main() -> None:
+    token = os.getenv("FERRIS_ELF_WORKER_TOKEN")
+    assert token, "No worker token passed"
+
+    # the protocol is plaintext, other machines should reach it through a
+    # tunnel rather than directly
+    host, _, port = os.getenv("FERRIS_ELF_WORKER_LISTEN", "127.0.0.1:7878").rpartition(
+        ":"
+    )
+    worker = LocalWorker(
+        os.getenv("FERRIS_ELF_WORKER_NAME") or os.uname().nodename,
+        int(os.getenv("FERRIS_ELF_BUILDERS", "2")),
+    )
+    asyncio.run(serve(worker, host, int(port), token))
@@ -1 +1,5 @@
-fn main() { if cfg!(target_os = "linux") { println!("cargo:rustc-link-lib=vulkan")} }
+fn main() {
+    // Don't rerun for every submitted lib.rs
+    println!("cargo:rerun-if-changed=build.rs");
+    if cfg!(target_os = "linux") { println!("cargo:rustc-link-lib=vulkan")}
+}
@@ -1,7 +1,11 @@
 #![feature(portable_simd)]
 #![allow(unused_unsafe)]
 use std::{
+    fmt::Write as _,
+    fs::File,
     hint::black_box,
+    io::Read,
+    path::Path,
     time::{Duration, Instant},
 };
 
@@ -15,98 +19,475 @@ impl<T: Copy> IntoInput<T> for T {
     }
 }
 
-impl IntoInput<&[u8]> for Vec<u8> {
-    fn into_input(self) -> &'static [u8] {
-        leak_to_page_aligned(self.leak())
-    }
-}
-
-impl IntoInput<&str> for Vec<u8> {
+impl IntoInput<&str> for &'static [u8] {
     fn into_input(self) -> &'static str {
-        let aligned = leak_to_page_aligned(self.leak());
-        std::str::from_utf8(aligned).unwrap()
+        std::str::from_utf8(self).unwrap()
     }
 }
 
-fn leak_to_page_aligned(s: &[u8]) -> &'static [u8] {
-    if s.is_empty() {
+/// Reads the file at `path` straight into a page aligned allocation, which is
+/// leaked so that the input outlives the benchmark.
+fn read_page_aligned(path: &Path) -> &'static [u8] {
+    let mut file = File::open(path).expect("Can't open input file");
+    let len = file.metadata().expect("Can't stat input file").len() as usize;
+
+    if len == 0 {
         #[repr(align(16384))]
         struct Aligned([u8; 0]);
         return const { &Aligned([]).0 };
     }
 
-    let layout = std::alloc::Layout::for_value(s)
-        .align_to(16 * 1024)
+    let layout = std::alloc::Layout::from_size_align(len, 16 * 1024)
         .expect("can't align layout");
 
-    // SAFETY: We checked that s is not empty, thus the layout has size > 0
-    let ptr = unsafe { std::alloc::alloc(layout) };
+    // SAFETY: We checked that len is not 0, thus the layout has size > 0
+    let ptr = unsafe { std::alloc::alloc_zeroed(layout) };
     if ptr.is_null() {
         std::alloc::handle_alloc_error(layout);
     }
 
-    // SAFETY: The pointer is not null and is valid for at least the layout of s
-    unsafe { std::ptr::copy_nonoverlapping(s.as_ptr(), ptr, s.len()) };
-
-    // SAFETY: The pointer is not null and is valid for at least the layout of s
-    unsafe { std::slice::from_raw_parts(ptr, s.len()) }
+    // SAFETY: The pointer is not null, valid and initialized for len bytes
+    let buf = unsafe { std::slice::from_raw_parts_mut(ptr, len) };
+    file.read_exact(buf).expect("Can't read input file");
+    buf
 }
 
 fn main() {
-    let input = std::env::var("INPUT").expect("No input file provided");
-    // let input = input.split(',').map(|s| s.parse().unwrap()).collect::<Vec<u8>>();
-    // let input = std::fs::read("input.txt").unwrap();
-    let (ans, mut times) = benchmark(input.into_bytes());
-
-    times.sort();
-    
-    println!("FERRIS_ELF_ANSWER {}", ans);
-    println!("FERRIS_ELF_MEDIAN {}", times[50].as_nanos());
-    println!("FERRIS_ELF_AVERAGE {}", times.iter().sum::<Duration>().as_nanos() / 100);
-    println!("FERRIS_ELF_MIN {}", times.iter().min().unwrap_or(&Duration::ZERO).as_nanos());
-    println!("FERRIS_ELF_MAX {}", times.iter().max().unwrap_or(&Duration::ZERO).as_nanos());
+    // Benchmark every input in the (read-only mounted) directory in turn. The
+    // CPU is already warm after the first input, so the later ones only warm
+    // up for long enough to estimate their batch size.
+    let dir = std::env::var_os("FERRIS_ELF_INPUTS").unwrap_or_else(|| "/inputs".into());
+    let mut paths = std::fs::read_dir(dir)
+        .expect("Can't read input directory")
+        .map(|entry| entry.expect("Can't read input directory").path())
+        .filter(|path| path.is_file())
+        .collect::<Vec<_>>();
+    paths.sort();
+
+    let adaptive = Adaptive::from_env();
+
+    // Profile runs also count hardware events, if the kernel lets us
+    let mut counters = std::env::var_os("FERRIS_ELF_PROFILE").and_then(|_| {
+        perf::Counters::open()
+            .inspect_err(|err| eprintln!("Hardware counters unavailable: {}", err))
+            .ok()
+    });
+
+    let full_warmup = if adaptive.is_some() {
+        Duration::from_secs(1)
+    } else {
+        Duration::from_secs(5)
+    };
+    let mut warmup = full_warmup;
+    let mut results = Vec::new();
+    for (i, path) in paths.iter().enumerate() {
+        // names are only for the result record, the solution's output is
+        // shown to its author
+        let name = path.file_name().unwrap().to_string_lossy().into_owned();
+        eprintln!("Benchmarking input {}", i + 1);
+        let input = read_page_aligned(path);
+        results.push(benchmark(input, warmup, adaptive.as_ref(), counters.as_mut()).to_json(&name));
+        warmup = full_warmup / 5;
+    }
+
+    // The result record goes to a file of its own, so that nothing the
+    // solution prints can interfere with it.
+    let out = std::env::var_os("FERRIS_ELF_RESULTS").unwrap_or_else(|| "/results/results.json".into());
+    let record = format!("{{\"version\":1,\"inputs\":[{}]}}", results.join(","));
+    std::fs::write(out, record).expect("Can't write results");
+}
+
+/// Hardware event counters of the benchmark thread, see `perf_event_open(2)`.
+mod perf {
+    use std::{
+        fs::File,
+        io::Read,
+        os::fd::{AsRawFd, FromRawFd},
+    };
+
+    /// `struct perf_event_attr` up to `config1`, which is `PERF_ATTR_SIZE_VER0`
+    #[repr(C)]
+    #[derive(Default)]
+    struct Attr {
+        kind: u32,
+        size: u32,
+        config: u64,
+        sample_period: u64,
+        sample_type: u64,
+        read_format: u64,
+        flags: u64,
+        wakeup_events: u32,
+        bp_type: u32,
+        config1: u64,
+    }
+
+    const TYPE_HARDWARE: u32 = 0;
+    const FORMAT_TOTAL_TIME_ENABLED: u64 = 1 << 0;
+    const FORMAT_TOTAL_TIME_RUNNING: u64 = 1 << 1;
+    const FLAG_DISABLED: u64 = 1 << 0;
+    const FLAG_EXCLUDE_KERNEL: u64 = 1 << 5;
+    const FLAG_EXCLUDE_HV: u64 = 1 << 6;
+    const IOC_ENABLE: u64 = 0x2400;
+    const IOC_DISABLE: u64 = 0x2401;
+    const IOC_RESET: u64 = 0x2403;
+
+    const SYS_PERF_EVENT_OPEN: Option<i64> = if cfg!(target_arch = "x86_64") {
+        Some(298)
+    } else if cfg!(target_arch = "aarch64") {
+        Some(241)
+    } else {
+        None
+    };
+
+    unsafe extern "C" {
+        fn syscall(number: i64, ...) -> i64;
+        fn ioctl(fd: i32, request: u64, ...) -> i32;
+    }
+
+    /// Names in the result record, with their `PERF_COUNT_HW_*` config
+    pub const EVENTS: [(&str, u64); 5] = [
+        ("cycles", 0),
+        ("instructions", 1),
+        ("cache_references", 2),
+        ("cache_misses", 3),
+        ("branch_misses", 5),
+    ];
+
+    /// One counter per event, counting user space on the calling thread only.
+    /// Threads the solution spawns, e.g. for rayon, aren't counted.
+    pub struct Counters {
+        files: Vec<File>,
+    }
+
+    impl Counters {
+        pub fn open() -> Result<Self, String> {
+            let number = SYS_PERF_EVENT_OPEN.ok_or("unsupported architecture")?;
+
+            let mut files = Vec::new();
+            for (name, config) in EVENTS {
+                let attr = Attr {
+                    kind: TYPE_HARDWARE,
+                    size: size_of::<Attr>() as u32,
+                    config,
+                    read_format: FORMAT_TOTAL_TIME_ENABLED | FORMAT_TOTAL_TIME_RUNNING,
+                    flags: FLAG_DISABLED | FLAG_EXCLUDE_KERNEL | FLAG_EXCLUDE_HV,
+                    ..Default::default()
+                };
+                // this thread, on any CPU, without a group or flags
+                let fd = unsafe { syscall(number, &raw const attr, 0i32, -1i32, -1i32, 0u64) };
+                if fd < 0 {
+                    return Err(format!("{}: {}", name, std::io::Error::last_os_error()));
+                }
+                // SAFETY: the kernel just gave us this descriptor
+                files.push(unsafe { File::from_raw_fd(fd as i32) });
+            }
+            Ok(Self { files })
+        }
+
+        pub fn reset(&self) {
+            for file in &self.files {
+                unsafe { ioctl(file.as_raw_fd(), IOC_RESET) };
+            }
+        }
+
+        /// Counts until `stop`, adding to the counts so far.
+        pub fn start(&self) {
+            for file in &self.files {
+                unsafe { ioctl(file.as_raw_fd(), IOC_ENABLE) };
+            }
+        }
+
+        pub fn stop(&self) {
+            for file in &self.files {
+                unsafe { ioctl(file.as_raw_fd(), IOC_DISABLE) };
+            }
+        }
+
+        /// Counts since `reset`, scaled up if the kernel had to share the
+        /// hardware counters between events, or None if they never ran.
+        pub fn read(&mut self) -> Option<Vec<f64>> {
+            let mut counts = Vec::new();
+            for file in &mut self.files {
+                let mut buf = [0u8; 24];
+                file.read_exact(&mut buf).ok()?;
+                let [value, enabled, running] =
+                    [0, 8, 16].map(|i| u64::from_ne_bytes(buf[i..i + 8].try_into().unwrap()));
+                if running == 0 {
+                    return None;
+                }
+                counts.push(value as f64 * enabled as f64 / running as f64);
+            }
+            Some(counts)
+        }
+    }
+}
+
+/// Configuration for adaptive benchmarking, which keeps sampling until the
+/// confidence interval of the median is narrow enough instead of running a
+/// fixed number of batches.
+struct Adaptive {
+    /// Target width of the confidence interval, relative to the median
+    ci_width: f64,
+    /// Never stop sampling before this much time has passed
+    min_time: Duration,
+    /// Always stop sampling once this much time has passed
+    max_time: Duration,
+}
+
+impl Adaptive {
+    const MIN_SAMPLES: usize = 10;
+    const MAX_SAMPLES: usize = 100_000;
+    /// Batches are sized to take about this long, so that timer overhead and
+    /// resolution don't matter for fast solutions.
+    const BATCH_TIME: Duration = Duration::from_millis(1);
+
+    fn from_env() -> Option<Self> {
+        let ci_width = std::env::var("FERRIS_ELF_CI_WIDTH")
+            .ok()?
+            .parse::<f64>()
+            .ok()
+            .filter(|width| *width > 0.0)?;
+
+        let secs = |name: &str, default: u64| {
+            std::env::var(name)
+                .ok()
+                .and_then(|v| v.parse::<f64>().ok())
+                .map(Duration::from_secs_f64)
+                .unwrap_or(Duration::from_secs(default))
+        };
+
+        Some(Self {
+            ci_width,
+            min_time: secs("FERRIS_ELF_MIN_TIME", 1),
+            max_time: secs("FERRIS_ELF_MAX_TIME", 10),
+        })
+    }
+}
+
+/// Distribution free 95% confidence interval for the median of sorted samples.
+fn median_ci(sorted: &[Duration]) -> (Duration, Duration) {
+    let n = sorted.len() as f64;
+    let half_width = 1.96 * n.sqrt() / 2.0;
+    let lo = (n / 2.0 - half_width).floor().max(0.0) as usize;
+    let hi = ((n / 2.0 + half_width).ceil() as usize).min(sorted.len() - 1);
+    (sorted[lo], sorted[hi])
+}
+
+fn percentile(sorted: &[Duration], p: f64) -> Duration {
+    sorted[((sorted.len() - 1) as f64 * p).round() as usize]
+}
+
+fn json_string(s: &str) -> String {
+    let mut out = String::with_capacity(s.len() + 2);
+    out.push('"');
+    for c in s.chars() {
+        match c {
+            '"' => out.push_str("\\\""),
+            '\\' => out.push_str("\\\\"),
+            c if (c as u32) < 0x20 => write!(out, "\\u{:04x}", c as u32).unwrap(),
+            c => out.push(c),
+        }
+    }
+    out.push('"');
+    out
+}
+
+struct Measurement {
+    answer: String,
+    /// Average time per run of each batch, in the order they were taken
+    times: Vec<Duration>,
+    warmup_iters: u32,
+    /// Runs per batch
+    iters: u32,
+    elapsed: Duration,
+    /// Average count of each of `perf::EVENTS` per run, in profile runs
+    counters: Option<Vec<f64>>,
+}
+
+impl Measurement {
+    fn to_json(&self, name: &str) -> String {
+        let mut sorted = self.times.clone();
+        sorted.sort_unstable();
+
+        let (ci_low, ci_high) = median_ci(&sorted);
+        let average = sorted.iter().sum::<Duration>() / sorted.len() as u32;
+
+        let mut samples = String::new();
+        for (i, time) in self.times.iter().enumerate() {
+            if i > 0 {
+                samples.push(',');
+            }
+            write!(samples, "{}", time.as_nanos()).unwrap();
+        }
+
+        let mut counters = String::new();
+        if let Some(counts) = &self.counters {
+            counters.push_str(",\"counters\":{");
+            for (i, ((name, _), count)) in perf::EVENTS.iter().zip(counts).enumerate() {
+                if i > 0 {
+                    counters.push(',');
+                }
+                write!(counters, "{}:{}", json_string(name), count).unwrap();
+            }
+            counters.push('}');
+        }
+
+        format!(
+            concat!(
+                "{{\"name\":{},\"answer\":{},",
+                "\"median\":{},\"average\":{},\"min\":{},\"max\":{},",
+                "\"p5\":{},\"p95\":{},\"ci_low\":{},\"ci_high\":{},",
+                "\"warmup_iterations\":{},\"iterations\":{},\"elapsed\":{},",
+                "\"samples\":[{}]{}}}"
+            ),
+            json_string(name),
+            json_string(&self.answer),
+            sorted[sorted.len() / 2].as_nanos(),
+            average.as_nanos(),
+            sorted[0].as_nanos(),
+            sorted[sorted.len() - 1].as_nanos(),
+            percentile(&sorted, 0.05).as_nanos(),
+            percentile(&sorted, 0.95).as_nanos(),
+            ci_low.as_nanos(),
+            ci_high.as_nanos(),
+            self.warmup_iters,
+            self.iters,
+            self.elapsed.as_nanos(),
+            samples,
+            counters,
+        )
+    }
 }
 
-fn benchmark(input: Vec<u8>) -> (String, [Duration; 100]) {
+fn benchmark(
+    input: &'static [u8],
+    warmup: Duration,
+    adaptive: Option<&Adaptive>,
+    counters: Option<&mut perf::Counters>,
+) -> Measurement {
     let input = input.into_input();
 
     let mut warmup_iters = 1;
 
     let answer = format!("{}", unsafe { ferris_elf::run(input) });
 
-    println!("Answer: {}, warming up for 5 sec...", answer);
+    eprintln!("Answer: {}, warming up for {:?}...", answer, warmup);
 
-    // Warm up the CPU etc for 5 seconds
+    // Warm up the CPU etc
     let warmup_start = Instant::now();
-    while warmup_start.elapsed() < Duration::from_secs(5) {
+    while warmup_start.elapsed() < warmup {
         if format!("{}", black_box(unsafe { ferris_elf::run(black_box(input)) })) != answer {
             panic!("Solution returned two different answers on same input!")
         }
         warmup_iters += 1;
     }
 
-    let estimated_dur = Duration::from_secs(5) / warmup_iters;
-    println!("Estimated duration per run: {:?}. Running {} iterations...", estimated_dur, warmup_iters);
+    let estimated_dur = warmup_start.elapsed() / warmup_iters;
 
-    let iters = (warmup_iters / 100).max(1);
+    let Some(adaptive) = adaptive else {
+        eprintln!("Estimated duration per run: {:?}. Running {} iterations...", estimated_dur, warmup_iters);
 
-    // Times for eacha batch
-    let mut times = [Duration::ZERO; 100];
+        let iters = (warmup_iters / 100).max(1);
 
-    // Benchmark in 100 batches
-    let mut start = Instant::now();
-    for sample in 0..100 {
+        // Times for eacha batch
+        let mut times = vec![Duration::ZERO; 100];
+
+        // Benchmark in 100 batches
+        if let Some(counters) = &counters {
+            counters.reset();
+            counters.start();
+        }
+        let bench_start = Instant::now();
+        let mut start = bench_start;
+        for sample in 0..100 {
+            for _ in 0..iters {
+                let _ = black_box(unsafe { ferris_elf::run(black_box(input)) });
+            }
+
+            // Record this batch
+            let elapsed = start.elapsed();
+            times[sample] = elapsed / iters;
+            start += elapsed;
+        }
+        let elapsed = bench_start.elapsed();
+
+        return Measurement {
+            answer,
+            counters: read_counters(counters, 100 * iters as usize),
+            times,
+            warmup_iters,
+            iters,
+            elapsed,
+        };
+    };
+
+    let iters = (Adaptive::BATCH_TIME.as_nanos() / estimated_dur.as_nanos().max(1)).max(1) as u32;
+    eprintln!("Estimated duration per run: {:?}. Running batches of {} iterations...", estimated_dur, iters);
+
+    let mut times = Vec::new();
+    let mut sorted = Vec::new();
+    // Checking the interval means sorting every sample so far, so only check
+    // after the sample count has grown by 10%.
+    let mut next_check = Adaptive::MIN_SAMPLES;
+
+    // Only the timed batches are counted, not checking the interval
+    if let Some(counters) = &counters {
+        counters.reset();
+    }
+    let bench_start = Instant::now();
+    loop {
+        if let Some(counters) = &counters {
+            counters.start();
+        }
+        let start = Instant::now();
         for _ in 0..iters {
             let _ = black_box(unsafe { ferris_elf::run(black_box(input)) });
         }
+        let batch = start.elapsed();
+        if let Some(counters) = &counters {
+            counters.stop();
+        }
+        times.push(batch / iters);
+
+        let elapsed = bench_start.elapsed();
+        if elapsed >= adaptive.max_time || times.len() >= Adaptive::MAX_SAMPLES {
+            break;
+        }
+
+        if elapsed < adaptive.min_time || times.len() < next_check {
+            continue;
+        }
+        next_check = times.len() + times.len() / 10;
 
-        // Record this batch
-        let elapsed = start.elapsed();
-        times[sample] = elapsed / iters;
-        start += elapsed;
+        sorted.clone_from(&times);
+        sorted.sort_unstable();
+        let (lo, hi) = median_ci(&sorted);
+        let median = sorted[sorted.len() / 2];
+        if (hi - lo).as_secs_f64() <= adaptive.ci_width * median.as_secs_f64() {
+            break;
+        }
     }
 
-    println!("Benchmark complete: {:#?}", times);
+    let elapsed = bench_start.elapsed();
+    eprintln!("Benchmark complete after {} samples in {:?}", times.len(), elapsed);
 
-    (answer, times)
+    Measurement {
+        answer,
+        counters: read_counters(counters, times.len() * iters as usize),
+        times,
+        warmup_iters,
+        iters,
+        elapsed,
+    }
+}
+
+/// Stops `counters` and divides their counts over the `runs` they counted.
+fn read_counters(counters: Option<&mut perf::Counters>, runs: usize) -> Option<Vec<f64>> {
+    let counters = counters?;
+    counters.stop();
+    let counts = counters.read();
+    if counts.is_none() {
+        eprintln!("Hardware counters didn't count");
+    }
+    Some(counts?.into_iter().map(|count| count / runs as f64).collect())
 }
@@ -1,23 +1,26 @@
-import sqlite3
+import sys
+
+from ferris_elf.database import Database
+from ferris_elf.hardware import leaderboard_hardware
+
+# usage: stats.py [hardware] [parallel]
+args = [arg for arg in sys.argv[1:] if arg != "parallel"]
+parallel = "parallel" in sys.argv[1:]
+
+db = Database("database.db", readonly=True)
+hardware = args[0] if args else leaderboard_hardware()
+
+best = {
+    (day, part): time
+    for part in range(1, 3)
+    for day, _part, _user, time in db.get_best_lb(part, hardware, parallel)
+}
 
-db = sqlite3.connect("database.db")
-cur = db.cursor()
 sum = 0
 for day in range(1, 26):
     for part in range(1, 3):
-        for (time,) in cur.execute(
-            "SELECT MIN(time) FROM runs INNER JOIN solutions on runs.answer2 LIKE solutions.answer2 WHERE solutions.day = ? AND solutions.part = ?",
-            (day, part),
-        ):
-            print(f"Day {day} part {part}: {time or '-'}ns")
-            sum += time or 0
-
-print("Total", sum, "ns")
+        time = best.get((day, part))
+        print(f"Day {day} part {part}: {time or '-'}ns")
+        sum += time or 0
 
-"""
-SELECT user, MIN(time) FROM runs
-INNER JOIN solutions
-        on runs.answer = solutions.answer
-WHERE solutions.day = ? AND solutions.part = 1
-GROUP BY user
-"""
+print("Total", sum, "ns on", hardware, "every core" if parallel else "one core")
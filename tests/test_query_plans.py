@@ -0,0 +1,76 @@
+import os
+import tempfile
+import unittest
+
+from ferris_elf.database import Database
+
+# Tables that the leaderboard, best time and verification queries must only
+# reach through an index
+indexed_tables = ("runs", "best_times")
+
+
+class QueryPlanTest(unittest.TestCase):
+    """EXPLAIN QUERY PLAN of the statements the hot database methods run."""
+
+    def setUp(self) -> None:
+        self.dir = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.dir.name, "database.db"))
+        self.db.insert_run(1, b"fn a() {}", 1, 1, 100.0, "42", 1, "a", "hw")
+        self.db.insert_run(2, b"fn b() {}", 1, 1, 200.0, "43", 1, "b", "hw")
+        self.db.commit()
+
+        self.statements: list[str] = []
+        self.db._db.set_trace_callback(self.statements.append)
+
+    def tearDown(self) -> None:
+        self.db._db.set_trace_callback(None)
+        self.db._db.close()
+        self.dir.cleanup()
+
+    def assertIndexed(self) -> None:
+        """Checks that none of the traced statements scans `indexed_tables`."""
+        cur = self.db._db.cursor()
+        statements = [
+            sql
+            for sql in self.statements
+            if sql.lstrip().upper().startswith(("SELECT", "INSERT", "UPDATE", "DELETE"))
+        ]
+        self.assertTrue(statements, "No statements were traced")
+        self.db._db.set_trace_callback(None)
+
+        for sql in statements:
+            plan = [row[3] for row in cur.execute(f"EXPLAIN QUERY PLAN {sql}")]
+            for table in indexed_tables:
+                for step in plan:
+                    self.assertFalse(
+                        step.startswith(f"SCAN {table}"),
+                        f"{step} in the plan of {sql}",
+                    )
+
+    def test_scores_leaderboard(self) -> None:
+        list(self.db.get_scores_lb(1, 1, "hw", False))
+        self.assertIndexed()
+
+    def test_best_leaderboard(self) -> None:
+        list(self.db.get_best_lb(1, "hw", False))
+        self.assertIndexed()
+
+    def test_best_time(self) -> None:
+        self.db.get_best(1, 1, 1, "hw", False)
+        self.assertIndexed()
+
+    def test_insert_run(self) -> None:
+        self.db.insert_run(3, b"fn c() {}", 1, 1, 50.0, "42", 1, "c", "hw")
+        self.assertIndexed()
+
+    def test_verify(self) -> None:
+        self.db.insert_solution("key", 1, 1, "42")
+        self.assertIndexed()
+
+    def test_refresh(self) -> None:
+        self.db.update_runs(1, 1, 150.0, "42", "a", "hw")
+        self.assertIndexed()
+
+
+if __name__ == "__main__":
+    unittest.main()